@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Headless phenotype benchmark -
+Runs the plant classifier over a directory of labelled images and reports
+accuracy, the confusion matrix and per-stage latency percentiles.
+
+Image names encode the ground truth: S/T (short/tall) followed by
+B/G/Y (brown/green/yellow), e.g. SB1.jpg or TG4.jpg.
+
+Usage:
+    python benchmark.py configs/settings.json test/logitech [--json out.json]
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import argparse
+import glob
+import json
+import os
+import re
+import time
+import numpy as np
+import cv2
+import vision
+
+# Ground truth
+HEIGHTS = {'S' : 'short', 'T' : 'tall'}
+COLORS = {'B' : 'brown', 'G' : 'green', 'Y' : 'yellow'}
+LABEL = re.compile(r'^([ST])([BGY])\d+$')
+
+def load_corpus(path):
+    """ Load every labelled image once, returns [(name, truth, bgr)] """
+    corpus = []
+    for filename in sorted(glob.glob(os.path.join(path, '*.jpg'))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        match = LABEL.match(name)
+        if match:
+            truth = (COLORS[match.group(2)], HEIGHTS[match.group(1)])
+            corpus.append((name, truth, cv2.imread(filename)))
+    return corpus
+
+def percentiles(samples):
+    samples = np.array(samples) * 1000.0 # milliseconds
+    return {
+        'mean' : float(np.mean(samples)),
+        'p50' : float(np.percentile(samples, 50)),
+        'p90' : float(np.percentile(samples, 90)),
+        'p99' : float(np.percentile(samples, 99)),
+        'max' : float(np.max(samples))
+    }
+
+def benchmark(classifier, corpus, repeat, batch=False):
+    """ Classify the corpus repeat times, the first pass is also a warm-up """
+    totals = []
+    stages = {}
+    predictions = {}
+    frames = np.array([bgr for (name, truth, bgr) in corpus])
+    for n in range(repeat + 1):
+        if batch:
+            start = time.time()
+            results = classifier.classify_batch(frames, annotate=False)
+            elapsed = (time.time() - start) / len(frames)
+            timings = [] # stages are only broken down frame by frame
+        else:
+            (results, timings) = ([], [])
+            for bgr in frames:
+                start = time.time()
+                results.append(classifier.classify(bgr))
+                timings.append(classifier.timings)
+                if n > 0: totals.append(time.time() - start)
+        if n == 0:
+            for ((name, truth, bgr), (color, height, annotated)) in zip(corpus, results):
+                predictions[name] = (color, height)
+            continue
+        if batch:
+            totals.extend([elapsed] * len(frames))
+        for t in timings:
+            for (stage, dt) in t.items():
+                stages.setdefault(stage, []).append(dt)
+    confusion = {}
+    for (name, truth, bgr) in corpus:
+        row = confusion.setdefault('%s %s' % truth, {})
+        predicted = '%s %s' % predictions[name]
+        row[predicted] = row.get(predicted, 0) + 1
+    n = float(len(corpus))
+    return {
+        'classifier' : classifier.classifier,
+        'batch' : batch,
+        'roi_scale' : classifier.roi_scale,
+        'images' : len(corpus),
+        'accuracy' : {
+            'overall' : sum(predictions[name] == truth for (name, truth, bgr) in corpus) / n,
+            'color' : sum(predictions[name][0] == truth[0] for (name, truth, bgr) in corpus) / n,
+            'height' : sum(predictions[name][1] == truth[1] for (name, truth, bgr) in corpus) / n
+        },
+        'confusion' : confusion,
+        'errors' : sorted(name for (name, truth, bgr) in corpus if predictions[name] != truth),
+        'latency_ms' : {
+            'total' : percentiles(totals),
+            'stages' : dict((stage, percentiles(t)) for (stage, t) in stages.items())
+        },
+        'frames_per_second' : len(totals) / sum(totals)
+    }
+
+def report(result):
+    print('Classifier: %s%s, ROI scale %d (%d images)' % (result['classifier'], ' batch' if result['batch'] else '', result['roi_scale'], result['images']))
+    print('Accuracy: %(overall).3f (color %(color).3f, height %(height).3f)' % result['accuracy'])
+    print('Errors: %s' % ', '.join(result['errors']))
+    print('Confusion (truth -> predicted):')
+    for truth in sorted(result['confusion']):
+        row = result['confusion'][truth]
+        print('    %-12s %s' % (truth, ', '.join('%s: %d' % (p, row[p]) for p in sorted(row))))
+    print('Latency (ms)          mean      p50      p90      p99')
+    latency = result['latency_ms']
+    for (stage, t) in [('total', latency['total'])] + sorted(latency['stages'].items()):
+        print('    %-14s %8.3f %8.3f %8.3f %8.3f' % (stage, t['mean'], t['p50'], t['p90'], t['p99']))
+    print('Throughput: %.1f frames/s' % result['frames_per_second'])
+    if 'roi_speedup' in result:
+        print('ROI speedup: %.2fx' % result['roi_speedup'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Phenotype accuracy and latency benchmark')
+    parser.add_argument('config', help='settings file, e.g. configs/settings.json')
+    parser.add_argument('images', help='directory of labelled images, e.g. test/logitech')
+    parser.add_argument('-c', '--classifier', action='append', help='classifier to run (repeatable), defaults to CAMERA_CLASSIFIER')
+    parser.add_argument('-n', '--repeat', type=int, default=10, help='timed passes over the corpus')
+    parser.add_argument('-b', '--batch', action='store_true', help='use classify_batch over the whole corpus')
+    parser.add_argument('--roi', type=int, metavar='SCALE', help='run with and without the region of interest at this downscale factor and report the speedup')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    corpus = load_corpus(args.images)
+    results = []
+    for name in (args.classifier or [None]):
+        overrides = {'CAMERA_CLASSIFIER' : name} if name else {}
+        if args.roi:
+            overrides['CAMERA_ROI_SCALE'] = 0
+            baseline = benchmark(vision.load_classifier(args.config, **overrides), corpus, args.repeat, args.batch)
+            report(baseline)
+            results.append(baseline)
+            overrides['CAMERA_ROI_SCALE'] = args.roi
+        result = benchmark(vision.load_classifier(args.config, **overrides), corpus, args.repeat, args.batch)
+        if args.roi:
+            result['roi_speedup'] = baseline['latency_ms']['total']['mean'] / result['latency_ms']['total']['mean']
+        report(result)
+        results.append(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
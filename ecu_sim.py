@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Stand-in for the ECU sketch on a pseudo-terminal -
+Follows the same state transitions and status protocol (text, or binary
+frames after 'X') as sketches/ECU/ECU.ino, optionally corrupting or dropping
+replies so the robot's recovery path can be exercised without hardware.
+
+Usage:
+    python ecu_sim.py                     # serve, point ARDUINO_DEV at the printed pty
+    python ecu_sim.py --speed 1           # with real action durations
+    python ecu_sim.py --bench 500 --errors 0.05
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import argparse
+import os
+import random
+import select
+import threading
+import time
+import tty
+from serial import Serial
+import protocol
+
+# Approximate action durations on the robot (seconds)
+DURATIONS = {
+    'B' : 2.0,
+    'A' : 1.5,
+    'S' : 2.0,
+    'E' : 2.0,
+    'G' : 1.0,
+    'T' : 3.0,
+    'J' : 3.0,
+    'F' : 2.4,
+    'W' : 0.1,
+    'C' : 0.1,
+    'P' : 0.5
+}
+PLANTS_PER_ROW = 5
+
+# Virtual controller
+class VirtualECU(object):
+    """ The state machine of loop() in ECU.ino, without the motors """
+
+    ## Initialize
+    def __init__(self, plants_per_row=PLANTS_PER_ROW):
+        self.plants_per_row = plants_per_row
+        self.command = '?'
+        self.result = 255
+        self.at_plant = 0
+        self.at_end = 0
+        self.pass_num = 0
+        self.line = 0
+        self.dist = 40
+        self.plants_seen = 0 # plants passed in the current row
+
+    ## Status
+    def status(self):
+        return dict((k, getattr(self, k)) for k in protocol.FIELDS)
+
+    ## Execute a command, returns its duration
+    def execute(self, val):
+        if val == 'R':
+            return 0.0 # repeat the last status
+        self.command = val
+        self.result = 0
+        if val == 'B':
+            (self.pass_num, self.at_end, self.at_plant) = (1, 0, 0)
+        elif val == 'A':
+            if self.pass_num in (1, 2):
+                self.at_end = self.pass_num
+        elif val == 'S':
+            if self.plants_seen < self.plants_per_row:
+                self.plants_seen += 1
+                self.result = 1
+                self.at_end = 0
+                self.at_plant = min(self.at_plant + 1, 5)
+            else:
+                self.plants_seen = 0
+                self.at_plant = 0
+                if self.pass_num in (1, 2):
+                    self.at_end = 3 - self.pass_num
+        elif val == 'E':
+            self.plants_seen = 0
+            self.at_plant = 0
+            if self.pass_num in (1, 2):
+                self.at_end = 3 - self.pass_num
+        elif val == 'T':
+            (self.at_end, self.at_plant) = (0, 0)
+            if self.pass_num == 1:
+                self.pass_num = 2
+        elif val == 'J':
+            (self.at_end, self.at_plant, self.pass_num) = (0, 0, 1)
+        elif val in ('F', 'C'):
+            (self.at_end, self.at_plant, self.pass_num) = (0, 0, 0)
+        elif val in ('G', 'W', 'P', protocol.BINARY_COMMAND):
+            pass
+        else:
+            self.command = '?'
+            self.result = 255
+        return DURATIONS.get(val, 0.0)
+
+# Pseudo-terminal server
+class Simulator(object):
+
+    ## Initialize
+    def __init__(self, speed=0.0, errors=0.0, seed=None):
+        self.ecu = VirtualECU()
+        self.speed = speed # fraction of the real action durations to sleep
+        self.errors = errors # probability of corrupting or dropping a reply
+        self.random = random.Random(seed)
+        self.binary = False
+        self.corrupted = 0
+        self.dropped = 0
+        (self.master, slave) = os.openpty()
+        tty.setraw(slave) # no newline translation of binary frames
+        self.slave = slave
+        self.port = os.ttyname(slave)
+
+    ## Reply to one command byte
+    def handle(self, val):
+        time.sleep(self.ecu.execute(val) * self.speed)
+        status = self.ecu.status()
+        reply = protocol.encode_frame(status) if self.binary else protocol.encode_text(status)
+        if val == protocol.BINARY_COMMAND:
+            self.binary = True # after the text reply, as the sketch does
+        elif self.random.random() < self.errors:
+            if self.random.random() < 0.5:
+                self.dropped += 1
+                return
+            i = self.random.randrange(len(reply))
+            reply = reply[:i] + chr(ord(reply[i]) ^ 0x5A) + reply[i + 1:]
+            self.corrupted += 1
+        os.write(self.master, reply)
+
+    ## Serve commands forever
+    def serve(self):
+        while True:
+            select.select([self.master], [], [])
+            for val in os.read(self.master, 64):
+                self.handle(val)
+
+# Benchmark
+def roundtrip(port, ecu, command, binary, timeout=0.2, retries=5):
+    """ Send a command and read its status the way Robot.execute_command does, returns the repeats needed """
+    port.write(command)
+    for attempt in range(retries + 1):
+        port.timeout = timeout
+        try:
+            if binary:
+                status = protocol.read_frame(lambda n: port.read(n) or _expired())
+            else:
+                line = port.readline()
+                if not line.endswith('\n'):
+                    _expired()
+                status = protocol.decode_text(line)
+            if status == ecu.status():
+                return attempt
+        except (SyntaxError, ValueError, IOError):
+            pass
+        port.reset_input_buffer()
+        port.write('R')
+    raise IOError('no status after %d repeats' % retries)
+
+def _expired():
+    raise IOError('timeout')
+
+def bench(count, errors, seed=None):
+    sim = Simulator(errors=errors, seed=seed)
+    server = threading.Thread(target=sim.serve, name='ecu')
+    server.daemon = True
+    server.start()
+    port = Serial(sim.port)
+    results = []
+    for binary in (False, True):
+        if binary:
+            roundtrip(port, sim.ecu, protocol.BINARY_COMMAND, False)
+        (repeats, start) = (0, time.time())
+        for i in range(count):
+            repeats += roundtrip(port, sim.ecu, 'W', binary)
+        elapsed = time.time() - start
+        size = len(protocol.encode_frame(sim.ecu.status()) if binary else protocol.encode_text(sim.ecu.status()))
+        results.append((binary, count / elapsed, size, repeats))
+    print('Protocol   statuses/s   bytes   wire ms @9600   wire ms @115200   repeats')
+    for (binary, rate, size, repeats) in results:
+        print('%-8s %12.0f %7d %15.2f %17.2f %9d' % ('binary' if binary else 'text', rate, size, size * 10000.0 / 9600, size * 10000.0 / 115200, repeats))
+    print('Injected: %d corrupted, %d dropped' % (sim.corrupted, sim.dropped))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ECU stand-in on a pseudo-terminal')
+    parser.add_argument('--speed', type=float, default=0.0, help='fraction of the real action durations to wait, 0 replies at once')
+    parser.add_argument('--errors', type=float, default=0.0, help='probability of corrupting or dropping each reply')
+    parser.add_argument('--seed', type=int, help='seed for the error injection')
+    parser.add_argument('--bench', type=int, metavar='N', help='time N round trips in text then binary mode and exit')
+    args = parser.parse_args()
+    if args.bench:
+        bench(args.bench, args.errors, args.seed)
+    else:
+        sim = Simulator(args.speed, args.errors, args.seed)
+        print('ECU listening on %s' % sim.port)
+        try:
+            sim.serve()
+        except KeyboardInterrupt:
+            pass
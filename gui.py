@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Competition display -
+Runs in its own process, started by the server when GUI_ENABLED is set. It
+subscribes to the server's state snapshots (and JPEG camera frames when they
+change) on GUI_PUB_ADDR, and sends the Run, Stop and Reset buttons back on
+GUI_CONTROL_ADDR, so drawing never delays a decision.
+
+Usage:
+    python gui.py configs/settings.json
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import json
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import zmq
+import cv2
+import pygtk
+pygtk.require('2.0')
+import gtk
+from metrics import Metrics, NullMetrics
+
+# Display
+class GUI(object):
+
+    ## Initialize Display
+    def __init__(self, object):
+        """
+        Requires super-object to have several handler functions:
+            - shutdown()
+            - close()
+            - reset()
+            - run()
+        """
+        try:
+            # CONSTANTS
+            self.GUI_LABEL_PASS = object.GUI_LABEL_PASS
+            self.GUI_LABEL_PLANTS = object.GUI_LABEL_PLANTS
+            self.GUI_LABEL_ROW = object.GUI_LABEL_ROW
+            self.GUI_LABEL_SAMPLES = object.GUI_LABEL_SAMPLES
+            self.GUI_LABEL_CLOCK = object.GUI_LABEL_CLOCK
+            self.GUI_BOARD_IMAGE = object.GUI_BOARD_IMAGE
+            self.stats = object.stats
+            # Window
+            self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+            self.window.set_size_request(object.GUI_WINDOW_X, object.GUI_WINDOW_Y)
+            self.window.connect("delete_event", object.close)
+            self.window.set_border_width(10)
+            self.window.show()
+            self.hbox = gtk.HBox(False, 0)
+            self.window.add(self.hbox)
+            # Buttons
+            self.hbox2 = gtk.HBox(False, 0)
+            self.vbox = gtk.VBox(False, 0)
+            self.vbox2 = gtk.VBox(False, 0)
+            self.hbox.add(self.vbox)
+            self.hbox2.show()
+            self.vbox2.show()
+            self.hbox3 = gtk.HBox(False, 0)
+            self.vbox3 = gtk.VBox(False, 0)
+            self.button_run = gtk.Button("Run") # Run Button
+            self.button_run.connect("clicked", object.run)
+            self.vbox3.pack_start(self.button_run, True, True, 0)
+            self.button_run.show()
+            self.button_stop = gtk.Button("Stop") # Stop Button
+            self.button_stop.connect("clicked", object.stop)
+            self.vbox3.pack_start(self.button_stop, True, True, 0)
+            self.button_stop.show()
+            self.button_reset = gtk.Button("Reset") # Reset Button
+            self.button_reset.connect("clicked", object.reset)
+            self.hbox3.pack_start(self.button_reset, True, True, 0)
+            self.hbox3.add(self.vbox3)
+            self.vbox2.add(self.hbox3)
+            self.hbox3.show()
+            self.vbox3.show()
+            self.button_reset.show()
+            self.vbox.add(self.vbox2)
+            self.label_plants = gtk.Label()
+            self.label_plants.set(object.GUI_LABEL_PLANTS)
+            self.label_plants.show()		
+            self.vbox2.add(self.label_plants)
+            self.label_samples = gtk.Label()
+            self.label_samples.set(object.GUI_LABEL_SAMPLES)
+            self.label_samples.show()		
+            self.vbox2.add(self.label_samples)
+            self.label_row = gtk.Label()
+            self.label_row.set(object.GUI_LABEL_ROW)
+            self.label_row.show()
+            self.vbox2.add(self.label_row)
+            self.label_pass = gtk.Label()
+            self.label_pass.set(object.GUI_LABEL_PASS)
+            self.label_pass.show()		
+            self.vbox2.add(self.label_pass)
+            self.label_clock = gtk.Label()
+            self.label_clock.set(object.GUI_LABEL_CLOCK)
+            self.label_clock.show()		
+            self.vbox2.add(self.label_clock)
+            # Camera Image
+            shape = (int(object.CAMERA_HEIGHT * object.GUI_CAMERA_SCALE), int(object.CAMERA_WIDTH * object.GUI_CAMERA_SCALE), 3)
+            self.camera_scaled = np.zeros(shape, np.uint8) # frames resized for the preview
+            self.camera_pix = gtk.gdk.pixbuf_new_from_array(self.camera_scaled, gtk.gdk.COLORSPACE_RGB, 8)
+            try:
+                self.camera_pixels = self.camera_pix.get_pixels_array() # the pixbuf's own memory
+            except Exception:
+                self.camera_pixels = None # pygtk without numpy, the pixbuf is rebuilt instead
+            if self.camera_pixels is not None and self.camera_pixels.flags['C_CONTIGUOUS']:
+                self.camera_rgb = self.camera_pixels # convert straight into the pixbuf
+            else:
+                self.camera_rgb = np.zeros(shape, np.uint8)
+            self.camera_version = None
+            self.camera_img = gtk.Image()
+            self.camera_img.set_from_pixbuf(self.camera_pix)
+            self.camera_img.show()
+            self.vbox2.add(self.camera_img)
+            self.vbox.show()
+            # Board Image
+            self.board_base = cv2.imread(object.GUI_BOARD_IMAGE) # decoded once
+            self.board_plants = self.board_base.copy() # base with the observed plants drawn in
+            self.board_bgr = self.board_base.copy() # plants with the robot marker, what is shown
+            self.board_drawn = {} # (row, plant) -> (color, height) drawn in board_plants
+            self.board_version = None
+            self.board_robot = None
+            self.board_pix = gtk.gdk.pixbuf_new_from_array(self.board_bgr, gtk.gdk.COLORSPACE_RGB, 8)
+            try:
+                self.board_pixels = self.board_pix.get_pixels_array() # the pixbuf's own memory
+            except Exception:
+                self.board_pixels = None # pygtk without numpy, the pixbuf is rebuilt instead
+            self.board_img = gtk.Image()
+            self.board_img.set_from_pixbuf(self.board_pix)
+            self.board_img.show()
+            self.hbox.add(self.board_img)
+            self.hbox.show()
+        except Exception as e:
+            raise e
+    
+    ## Update GUI
+    def update_gui(self, ps, r, pl, s, t):
+        self.label_pass.set(self.GUI_LABEL_PASS % ps)
+        self.label_row.set(self.GUI_LABEL_ROW % r)
+        self.label_plants.set(self.GUI_LABEL_PLANTS % pl)
+        self.label_samples.set(self.GUI_LABEL_SAMPLES % s)
+        self.label_clock.set(self.GUI_LABEL_CLOCK % t)
+        while gtk.events_pending():
+            gtk.main_iteration_do(False)
+    
+    ## Draw Board
+    def draw_board(self, plants, robot_position, version, x=75, y=132, x_pad=154, y_pad=40, brown=(116,60,12), yellow=(219,199,6), green=(0,255,0), tall=7, short=2):
+        """
+        Redraw only what changed - the plants only when the board's version
+        does, and then only the positions whose phenotype changed, and the
+        robot marker only when it moves, so most refreshes do nothing
+        """
+        try:
+            start = time.time()
+            (W,H,D) = self.board_base.shape
+            if version == self.board_version and robot_position == self.board_robot:
+                self.stats.inc('board_skips')
+                return
+
+            # Plants
+            shown = dict(((r,p), (c,h)) for (r,p,c,h) in plants) if version != self.board_version else self.board_drawn
+            reach = tall + 9 # outer radius of the thickest circle
+            for (r,p) in set(self.board_drawn) | set(shown):
+                if self.board_drawn.get((r,p)) == shown.get((r,p)):
+                    continue
+                (cx, cy) = ((W - (((p-1) * x) + x_pad)), (H - (((r-1) * y) + y_pad)))
+                patch = (slice(max(cy - reach, 0), cy + reach + 1), slice(max(cx - reach, 0), cx + reach + 1))
+                self.board_plants[patch] = self.board_base[patch] # erase
+                if (r,p) not in shown:
+                    continue
+                (c,h) = shown[(r,p)]
+                if h == 'tall':
+                    radius = tall
+                if h == 'short':
+                    radius = short
+                if c == 'green':
+                    color = green
+                if c == 'yellow':
+                    color = yellow
+                if c == 'brown':
+                    color = brown
+                if c == 'blue':
+                    color = (255,0,0)
+                cv2.circle(self.board_plants, (cx, cy), radius, color, thickness=15)
+            self.board_drawn = shown
+            self.board_version = version
+
+            # Robot
+            (row_num, at_plant, pass_num, at_end) = robot_position
+            if at_end == 0:
+                if row_num == 0: # if at beginning
+                    (center_x, center_y) = (W - 55, H - 55) ## 55, 55 is best
+                elif at_plant != 0:  # if at plant
+                    if pass_num == 1:
+                        (center_x, center_y) = (W - (at_plant) * x - 77, H - (row_num - 1) * y - 110)
+                    elif pass_num == 2:
+                        (center_x, center_y) = (W - (6 - at_plant) * x - 77, H - (row_num - 1) * y - 110)
+                elif pass_num == 2: # unaligned post-turn
+                    (center_x, center_y) = (W - 470, H - (row_num - 1) * y - 110) 
+                elif row_num >= 1: # unaligned post-jump
+                    (center_x, center_y) = (W - 130, H - (row_num - 1) * y - 110) 
+                elif row_num > 4: # to finish
+                    (center_x, center_y) = (W - 130, H - (row_num - 1) * y - 110)
+                else: # somewhere after plant
+                    (center_x, center_y) = (W - 470, H - (row_num - 1) * y - 110)
+            elif at_end == 1:
+                (center_x, center_y) = (W - 110, H - (row_num-1) * y - 110) # right side at row
+            elif at_end == 2:
+                (center_x, center_y) = (W - 500, H - (row_num-1) * y - 110) # left side at some row  
+            else:
+                (center_x, center_y) = (W - 55, H - 55)          
+            top_left = ((center_x - 20), (center_y - 20))
+            bottom_right = ((center_x + 20), (center_y + 20 ))
+            self.board_bgr[:] = self.board_plants
+            cv2.rectangle(self.board_bgr, top_left, bottom_right, (255,0,0), thickness=5)
+            self.board_robot = robot_position
+
+            # Display
+            if self.board_pixels is not None:
+                self.board_pixels[:] = self.board_bgr
+                self.board_img.queue_draw()
+            else:
+                self.board_pix = gtk.gdk.pixbuf_new_from_array(self.board_bgr, gtk.gdk.COLORSPACE_RGB, 8)
+                self.board_img.set_from_pixbuf(self.board_pix)
+            self.stats.inc('board_redraws')
+            self.stats.observe('board_draw_time', time.time() - start)
+        except Exception as e:
+            print str(e)
+
+    ## Draw Camera
+    def draw_camera(self, bgr, version=None):
+        """ Convert and show the frame, unless this version is already shown """
+        try:
+            if version is not None and version == self.camera_version:
+                self.stats.inc('camera_skips')
+                return
+            start = time.time()
+            (h, w) = self.camera_rgb.shape[:2]
+            if bgr.shape[:2] != (h, w):
+                bgr = cv2.resize(bgr, (w, h), self.camera_scaled, interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, self.camera_rgb)
+            if self.camera_pixels is None:
+                self.camera_pix = gtk.gdk.pixbuf_new_from_array(self.camera_rgb, gtk.gdk.COLORSPACE_RGB, 8)
+                self.camera_img.set_from_pixbuf(self.camera_pix)
+            else:
+                if self.camera_rgb is not self.camera_pixels:
+                    self.camera_pixels[:] = self.camera_rgb
+                self.camera_img.queue_draw()
+            self.camera_version = version
+            self.stats.inc('camera_redraws')
+            self.stats.observe('camera_draw_time', time.time() - start)
+        except Exception as e:
+            print str(e)
+
+# Subscriber
+class Viewer(object):
+    """ The GUI's super-object, forwards its handlers to the server """
+
+    ## Initialize
+    def __init__(self, config_path):
+        self.load_config(config_path)
+        self.stats = Metrics() if self.METRICS_ENABLED else NullMetrics()
+        self.context = zmq.Context()
+        self.snapshots = self.context.socket(zmq.SUB)
+        self.snapshots.setsockopt(zmq.SUBSCRIBE, '')
+        self.snapshots.setsockopt(zmq.RCVHWM, 2)
+        self.snapshots.connect(self.GUI_PUB_ADDR)
+        self.controls = self.context.socket(zmq.PUSH)
+        self.controls.setsockopt(zmq.LINGER, 0)
+        self.controls.connect(self.GUI_CONTROL_ADDR)
+        self.showing = True
+        self.stats_time = 0.0 # last time the stats went to the server
+        self.gui = GUI(self)
+        self.gui.draw_camera(cv2.imread(self.GUI_CAMERA_IMAGE)) # until the server's first frame
+
+    ## Useful Functions
+    def pretty_print(self, task, msg):
+        date = datetime.strftime(datetime.now(), '%d/%b/%Y:%H:%M:%S')
+        print('[%s] %s\t%s' % (date, task, msg))
+    def load_config(self, config_path):
+        with open(config_path) as config:
+            settings = json.loads(config.read())
+            for key in settings:
+                setattr(self, key, settings[key])
+
+    ## Handlers
+    def send(self, command, **fields):
+        try:
+            self.controls.send(json.dumps(dict(fields, command=command)), zmq.NOBLOCK)
+        except zmq.ZMQError as error:
+            self.pretty_print('GUI', 'Server not listening: %s' % str(error))
+    def send_stats(self):
+        """ Redraw metrics for the server to serve with its own """
+        if self.stats.enabled:
+            self.send('stats', stats=self.stats.state())
+        self.stats_time = time.time()
+    def run(self, widget):
+        self.send('run')
+    def stop(self, widget):
+        self.send('stop')
+    def reset(self, widget):
+        self.send('reset')
+    def close(self, widget, event=None):
+        self.showing = False
+
+    ## Show snapshots until the window is closed
+    def loop(self, timeout=100):
+        while self.showing:
+            parts = None
+            if self.snapshots.poll(timeout):
+                try:
+                    while True: # skip to the newest snapshot
+                        parts = self.snapshots.recv_multipart(zmq.NOBLOCK)
+                        if len(parts) > 1:
+                            self.show_frame(parts)
+                except zmq.Again:
+                    pass
+            if parts is not None:
+                self.show(json.loads(parts[0]))
+            else:
+                while gtk.events_pending():
+                    gtk.main_iteration_do(False)
+            if time.time() - self.stats_time > self.GUI_STATS_INTERVAL:
+                self.send_stats()
+        self.send_stats()
+        if self.VERBOSE:
+            self.pretty_print('GUI', json.dumps(self.stats.snapshot(), sort_keys=True))
+        self.snapshots.close()
+        self.controls.close()
+        self.context.term()
+    def show_frame(self, parts):
+        snapshot = json.loads(parts[0])
+        bgr = cv2.imdecode(np.frombuffer(parts[1], np.uint8), cv2.IMREAD_COLOR)
+        if bgr is not None:
+            self.gui.draw_camera(bgr, snapshot['frame_version'])
+    def show(self, snapshot):
+        self.gui.draw_board(snapshot['plants'], tuple(snapshot['robot_position']), snapshot['board_version'])
+        self.gui.update_gui(snapshot['pass_num'], snapshot['row_num'], snapshot['plant_num'], snapshot['samples_num'], snapshot['clock'])
+
+if __name__ == '__main__':
+    try:
+        config_path = sys.argv[1]
+    except IndexError:
+        print('NO CONFIGURATION FILE GIVEN')
+        exit(1)
+    viewer = Viewer(config_path)
+    try:
+        viewer.loop()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Server load test -
+Runs N simulated robots against a running server on localhost, each in its
+own process with its own ZMQ identity (so its own session on the server).
+Each robot drives a VirtualECU from the server's actions and sends the same
+requests as Robot.request_action, with a burst of labelled test images at
+every plant. Frames are encoded once up front so the clients measure the
+server, not their own encoder. Reports throughput and round-trip latency.
+
+Usage:
+    python server.py configs/settings.json &
+    python loadtest.py configs/settings.json --clients 8 --requests 500
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+import numpy as np
+import zmq
+import cv2
+from benchmark import load_corpus, percentiles
+from ecu_sim import VirtualECU
+
+# Frames
+def encode_frame(bgr, encoding, quality):
+    """ As Robot.encode_frame, returns (header fields, payload) """
+    if encoding == 'jpeg':
+        (s, jpg) = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return {'encoding' : 'jpeg'}, jpg.tostring()
+    elif encoding == 'json':
+        return {'bgr' : bgr.tolist()}, None
+    bgr = np.ascontiguousarray(bgr)
+    return {'encoding' : 'raw', 'shape' : bgr.shape, 'dtype' : str(bgr.dtype)}, bgr.tostring()
+
+# Simulated robot
+def client(n, settings, args, frames, results):
+    """ Send args.requests requests, puts (n, latencies, actions, error) on results """
+    names = dict((v, k) for (k, v) in settings['ACTIONS'].items())
+    rng = random.Random(n)
+    context = zmq.Context()
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.IDENTITY, '%s-%d-%d' % (args.prefix, os.getppid(), n))
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(args.addr)
+    ecu = VirtualECU()
+    (latencies, actions, error) = ([], {}, None)
+    for i in range(args.requests):
+        status = ecu.status()
+        request = {
+            'type' : 'request',
+            'last_action' : names[status['command']],
+            'result' : status['result'],
+            'at_end' : status['at_end'],
+            'at_plant' : status['at_plant'],
+            'pass_num' : status['pass_num']
+        }
+        burst = [rng.choice(frames)] * (args.burst if status['at_plant'] else 1)
+        request.update(burst[0][0])
+        dump = json.dumps(request)
+        start = time.time()
+        if burst[0][1] is None:
+            socket.send(dump)
+        else:
+            socket.send_multipart([dump] + [payload for (fields, payload) in burst])
+        if not socket.poll(settings['ZMQ_TIMEOUT']):
+            error = 'timeout after %d requests' % i
+            break
+        action = json.loads(socket.recv())['action']
+        latencies.append(time.time() - start)
+        actions[action] = actions.get(action, 0) + 1
+        time.sleep(ecu.execute(settings['ACTIONS'][action]) * args.speed)
+    socket.close()
+    context.term()
+    results.put((n, latencies, actions, error))
+
+# Load test
+def run(settings, args):
+    corpus = load_corpus(args.images)
+    if not corpus:
+        corpus = [(None, None, np.zeros((settings['CAMERA_HEIGHT'], settings['CAMERA_WIDTH'], 3), np.uint8))]
+    frames = [encode_frame(bgr, args.encoding, settings['ZMQ_JPEG_QUALITY']) for (name, truth, bgr) in corpus]
+    context = zmq.Context()
+    controls = context.socket(zmq.PUSH)
+    controls.connect(args.control)
+    controls.send(json.dumps({'command' : 'run'})) # sessions only decide once running
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=client, args=(n, settings, args, frames, results)) for n in range(args.clients)]
+    start = time.time()
+    for p in clients:
+        p.start()
+    finished = [results.get() for p in clients]
+    elapsed = time.time() - start
+    for p in clients:
+        p.join()
+    controls.close()
+    context.term()
+    latencies = [t for (n, l, a, e) in finished for t in l]
+    actions = {}
+    for (n, l, a, e) in finished:
+        for (action, count) in a.items():
+            actions[action] = actions.get(action, 0) + count
+    return {
+        'clients' : args.clients,
+        'requests' : len(latencies),
+        'elapsed' : elapsed,
+        'requests_per_second' : len(latencies) / elapsed,
+        'latency_ms' : percentiles(latencies) if latencies else {},
+        'actions' : actions,
+        'errors' : dict((n, e) for (n, l, a, e) in finished if e)
+    }
+
+def report(result):
+    print('Clients: %d, %d requests in %.2f s' % (result['clients'], result['requests'], result['elapsed']))
+    print('Throughput: %.0f requests/s' % result['requests_per_second'])
+    if result['latency_ms']:
+        t = result['latency_ms']
+        print('Latency (ms): mean %.2f, p50 %.2f, p90 %.2f, p99 %.2f, max %.2f' % (t['mean'], t['p50'], t['p90'], t['p99'], t['max']))
+    print('Actions: %s' % ', '.join('%s %d' % item for item in sorted(result['actions'].items())))
+    for (n, error) in sorted(result['errors'].items()):
+        print('    client %d: %s' % (n, error))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the server with simulated robots')
+    parser.add_argument('config', help='settings file, e.g. configs/settings.json')
+    parser.add_argument('--addr', help='server address, defaults to port of ZMQ_HOST on localhost')
+    parser.add_argument('--control', help='server control address, defaults to GUI_CONTROL_ADDR')
+    parser.add_argument('--clients', type=int, default=4, help='simulated robots')
+    parser.add_argument('--requests', type=int, default=200, help='requests per robot')
+    parser.add_argument('--images', default='test/logitech', help='directory of labelled images to send as frames')
+    parser.add_argument('--encoding', help='frame encoding, defaults to ZMQ_FRAME_ENCODING')
+    parser.add_argument('--burst', type=int, help='frames per plant, defaults to CAMERA_BURST_FRAMES')
+    parser.add_argument('--speed', type=float, default=0.0, help='fraction of the real action durations to wait, 0 sends at once')
+    parser.add_argument('--prefix', default='loadtest', help='robot identity prefix')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    with open(args.config) as config:
+        settings = json.loads(config.read())
+    args.addr = args.addr or 'tcp://127.0.0.1:%s' % settings['ZMQ_HOST'].rsplit(':', 1)[1]
+    args.control = args.control or settings['GUI_CONTROL_ADDR']
+    args.encoding = args.encoding or settings['ZMQ_FRAME_ENCODING']
+    args.burst = args.burst or settings['CAMERA_BURST_FRAMES']
+    result = run(settings, args)
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=4, sort_keys=True)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Lightweight counters and latency histograms shared by the server and robot -
+Blocks are timed with spans (with stats.span('decode'): ...), and every
+metric can be exported as JSON or Prometheus text. NullMetrics has the same
+interface and records nothing, for running with metrics disabled.
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import json
+import re
+import threading
+import time
+from bisect import bisect_left
+
+# Default histogram bucket upper bounds (seconds)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Histogram
+class Histogram(object):
+
+    ## Initialize
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    ## Record a sample
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    ## Approximate percentile (upper bound of the bucket holding it)
+    def percentile(self, q):
+        if self.count == 0:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                if i < len(self.buckets):
+                    return min(self.buckets[i], self.max)
+                return self.max
+        return self.max
+
+    ## Summary
+    def cumulative(self):
+        """ Returns ([(upper bound, samples at or below it)], count, sum), ending with +Inf """
+        with self.lock:
+            (counts, count, total) = (list(self.counts), self.count, self.sum)
+        buckets = []
+        seen = 0
+        for (bound, n) in zip(self.buckets + (float('inf'),), counts):
+            seen += n
+            buckets.append((bound, seen))
+        return buckets, count, total
+    def state(self):
+        """ Raw bucket counts, for rebuilding the histogram in another process """
+        with self.lock:
+            return {'buckets' : list(self.buckets), 'counts' : list(self.counts), 'count' : self.count, 'sum' : self.sum, 'min' : self.min, 'max' : self.max}
+    @classmethod
+    def from_state(cls, state):
+        histogram = cls(state['buckets'])
+        histogram.counts = list(state['counts'])
+        (histogram.count, histogram.sum, histogram.min, histogram.max) = (state['count'], state['sum'], state['min'], state['max'])
+        return histogram
+    def snapshot(self):
+        with self.lock:
+            count = self.count
+            total = self.sum
+            (low, high) = (self.min, self.max)
+        return {
+            'count' : count,
+            'sum' : total,
+            'mean' : total / count if count else None,
+            'min' : low,
+            'max' : high,
+            'p50' : self.percentile(50),
+            'p90' : self.percentile(90),
+            'p99' : self.percentile(99)
+        }
+
+# Spans
+class Span(object):
+    """ Times a with-block into a histogram """
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start)
+        return False
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+NULL_SPAN = NullSpan()
+
+# Registry
+class Metrics(object):
+    enabled = True
+
+    ## Initialize
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    ## Histograms
+    def histogram(self, name):
+        try:
+            return self.histograms[name]
+        except KeyError:
+            with self.lock:
+                return self.histograms.setdefault(name, Histogram())
+    def observe(self, name, value):
+        self.histogram(name).observe(value)
+    def span(self, name):
+        return Span(self.histogram(name))
+
+    ## Counters and gauges
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    ## Summary of every metric
+    def snapshot(self):
+        return {
+            'histograms' : dict((k, h.snapshot()) for (k, h) in self.histograms.items()),
+            'counters' : dict(self.counters),
+            'gauges' : dict(self.gauges)
+        }
+    def state(self):
+        """ Every metric with its raw histogram buckets, see from_state() """
+        return {
+            'histograms' : dict((k, h.state()) for (k, h) in self.histograms.items()),
+            'counters' : dict(self.counters),
+            'gauges' : dict(self.gauges)
+        }
+    @classmethod
+    def from_state(cls, state):
+        """ Rebuild the metrics of another process from its state() """
+        metrics = cls()
+        metrics.histograms = dict((k, Histogram.from_state(h)) for (k, h) in state['histograms'].items())
+        metrics.counters = dict(state['counters'])
+        metrics.gauges = dict(state['gauges'])
+        return metrics
+
+    ## Export
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+    def prometheus(self, prefix=''):
+        """ Text exposition format, histograms (in seconds) with cumulative buckets """
+        lines = []
+        for (name, histogram) in sorted(self.histograms.items()):
+            metric = _metric_name(prefix + name)
+            (buckets, count, total) = histogram.cumulative()
+            lines.append('# TYPE %s histogram' % metric)
+            for (bound, seen) in buckets:
+                lines.append('%s_bucket{le="%s"} %d' % (metric, '+Inf' if bound == float('inf') else '%g' % bound, seen))
+            lines.append('%s_sum %r' % (metric, total))
+            lines.append('%s_count %d' % (metric, count))
+        for (name, value) in sorted(self.counters.items()):
+            metric = _metric_name(prefix + name) + '_total'
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %r' % (metric, value))
+        for (name, value) in sorted(self.gauges.items()):
+            metric = _metric_name(prefix + name)
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s %r' % (metric, float(value)))
+        return '\n'.join(lines) + '\n'
+
+def _metric_name(name):
+    return re.sub('[^a-zA-Z0-9_:]', '_', name)
+
+class NullMetrics(Metrics):
+    """ Metrics disabled - recording is a no-op and spans are a shared do-nothing context """
+    enabled = False
+
+    def observe(self, name, value):
+        pass
+    def span(self, name):
+        return NULL_SPAN
+    def inc(self, name, value=1):
+        pass
+    def gauge(self, name, value):
+        pass
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Status protocol between the ECU sketch and the robot -
+Text statuses are dict literals terminated by a newline, binary statuses are
+fixed-layout frames: START_BYTE, payload length, payload, CRC-8 over the
+length and payload. The binary frame is 12 bytes against ~90 for the text.
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import ast
+import struct
+
+# Framing
+START_BYTE = '\xa5'
+BINARY_COMMAND = 'X' # reply in text, then switch to binary frames at the fast baud
+STATUS = struct.Struct('<cBbbbhh') # must match send_frame() in ECU.ino
+FIELDS = ('command', 'result', 'at_plant', 'at_end', 'pass_num', 'line', 'dist')
+TEXT_FORMAT = "{'command':'%s','result':%d,'at_plant':%d,'at_end':%d,'pass_num':%d,'line':%d,'dist':%d}"
+
+# CRC-8 (polynomial 0x07, initial value 0)
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+CRC8_TABLE = _crc8_table()
+
+def crc8(data):
+    crc = 0
+    for c in data:
+        crc = CRC8_TABLE[crc ^ ord(c)]
+    return crc
+
+# Encoding
+def encode_frame(status):
+    payload = STATUS.pack(*[status[k] for k in FIELDS])
+    body = chr(len(payload)) + payload
+    return START_BYTE + body + chr(crc8(body))
+
+def encode_text(status):
+    return TEXT_FORMAT % tuple(status[k] for k in FIELDS) + '\r\n'
+
+# Decoding
+def decode_text(line):
+    """ Parse a text status line, raises SyntaxError or ValueError if it is garbled """
+    status = ast.literal_eval(line.strip())
+    if not isinstance(status, dict):
+        raise ValueError('not a status: %r' % line)
+    return status
+
+def read_exactly(read, n):
+    """ Read n bytes with read(), which may return early on the port timeout """
+    data = ''
+    while len(data) < n:
+        data += read(n - len(data))
+    return data
+
+def read_frame(read):
+    """
+    Read the next binary status frame with read(n) and return the status;
+    bytes before the start byte are skipped, and a frame with a bad length
+    or checksum raises ValueError
+    """
+    while read(1) != START_BYTE:
+        pass
+    length = read_exactly(read, 1)
+    if ord(length) != STATUS.size:
+        raise ValueError('bad frame length %d' % ord(length))
+    payload = read_exactly(read, STATUS.size)
+    crc = read_exactly(read, 1)
+    if crc8(length + payload) != ord(crc):
+        raise ValueError('bad frame checksum')
+    return dict(zip(FIELDS, STATUS.unpack(payload)))
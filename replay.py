@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Strategy replay and simulation -
+Drives the server's StateMachine without a robot, GUI or wall clock, either
+from a recorded run (see storage.RunRecorder) or from virtual runs in which
+the ECU state machine moves over a field of labelled test images. Reports
+decisions per second and decision latency by action.
+
+Usage:
+    python replay.py configs/settings.json --runs 1000 --oracle
+    python replay.py configs/settings.json --images test/logitech --runs 20
+    python replay.py configs/settings.json --record data/runs/20150801_120000
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import argparse
+import json
+import random
+import time
+import numpy as np
+import vision
+from benchmark import load_corpus, percentiles
+from ecu_sim import VirtualECU, PLANTS_PER_ROW
+from strategy import StateMachine, compile_rules, load_rules
+
+# Virtual clock
+class VirtualClock(object):
+
+    ## Initialize
+    def __init__(self, now=0.0):
+        self.now = now
+    def __call__(self):
+        return self.now
+    def advance(self, seconds):
+        self.now += seconds
+
+def quiet(task, msg):
+    pass
+
+# Virtual runs
+def make_field(corpus, num_rows, rng):
+    """ Assign a labelled image to every plant position, returns {(row, plant) : (truth, bgr)} """
+    return dict(((row, plant), rng.choice(corpus)[1:]) for row in range(1, num_rows + 1) for plant in range(1, PLANTS_PER_ROW + 1))
+
+def virtual_run(settings, table, field, identify, latency=0.1, burst=1, max_steps=1000):
+    """
+    One run of the strategy against the virtual ECU, with latency seconds of
+    virtual time per request on top of each action's duration
+    """
+    clock = VirtualClock()
+    names = dict((v, k) for (k, v) in settings['ACTIONS'].items())
+    machine = StateMachine(settings['NUM_ROWS'], settings['NUM_PLANTS'], settings['RUN_TIME'], settings['GIVE_UP_TIME'], table, identify, clock=clock, log=quiet)
+    machine.running = True
+    ecu = VirtualECU()
+    blank = np.zeros((settings['CAMERA_HEIGHT'], settings['CAMERA_WIDTH'], 3), np.uint8)
+    decisions = []
+    truths = {}
+    for step in range(max_steps):
+        machine.tick()
+        if not machine.running:
+            break # out of time
+        status = ecu.status()
+        request = dict(status, last_action=names[status['command']], frames=[blank])
+        if status['at_plant']:
+            if status['pass_num'] == 2:
+                position = (machine.row_num + 1, 6 - status['at_plant'])
+            else:
+                position = (machine.row_num, status['at_plant'])
+            if position in field:
+                (truth, bgr) = field[position]
+                truths[position] = truth
+                request['frames'] = [bgr] * burst
+        request['bgr'] = request['frames'][-1]
+        start = time.time()
+        action = machine.decide_action(request)
+        decisions.append((action, time.time() - start))
+        if action == 'wait' and machine.last_action in ('finish', 'wait'):
+            break # finished
+        clock.advance(ecu.execute(settings['ACTIONS'][action]) + latency)
+    correct = sum(truths.get((r, p)) == (c, h) for (r, p, c, h) in machine.observed_plants)
+    return {
+        'decisions' : decisions,
+        'time' : clock.now,
+        'finished' : machine.last_action in ('finish', 'wait') and bool(decisions) and decisions[-1][0] == 'wait',
+        'plants' : machine.plant_num,
+        'correct' : correct,
+        'samples' : machine.samples_num
+    }
+
+def simulate(settings, table, corpus, identify, runs, latency=0.1, burst=1, seed=None):
+    rng = random.Random(seed)
+    results = []
+    start = time.time()
+    for n in range(runs):
+        results.append(virtual_run(settings, table, make_field(corpus, settings['NUM_ROWS'], rng), identify, latency, burst))
+    elapsed = time.time() - start
+    decisions = [d for r in results for d in r['decisions']]
+    return {
+        'runs' : runs,
+        'decisions' : len(decisions),
+        'elapsed' : elapsed,
+        'decisions_per_second' : len(decisions) / elapsed,
+        'latency_ms' : by_action(decisions),
+        'virtual_time' : {
+            'mean' : float(np.mean([r['time'] for r in results])),
+            'p90' : float(np.percentile([r['time'] for r in results], 90))
+        },
+        'finished' : sum(r['finished'] for r in results),
+        'plants' : float(np.mean([r['plants'] for r in results])),
+        'correct' : float(np.mean([r['correct'] for r in results])),
+        'samples' : float(np.mean([r['samples'] for r in results]))
+    }
+
+# Recorded runs
+def replay_record(settings, table, path, identify):
+    """
+    Feed a recorded run back through the strategy and compare decisions,
+    with a state machine per robot following the recorded resets and
+    pause or run state
+    """
+    from storage import RunReader
+    reader = RunReader(path)
+    clock = VirtualClock(reader.times[0] if len(reader) else 0.0)
+    machines = {}
+    decisions = []
+    mismatches = []
+    start = time.time()
+    for n in range(len(reader)):
+        (meta, parts) = reader[n]
+        request = dict(meta['request'], frames=reader.frames(n))
+        request['bgr'] = request['frames'][-1]
+        state = meta.get('state')
+        if not isinstance(state, dict):
+            state = {} # recorded before the run state was
+        clock.now = reader.times[n]
+        machine = machines.get(request.get('robot'))
+        if machine is None:
+            machine = machines[request.get('robot')] = StateMachine(settings['NUM_ROWS'], settings['NUM_PLANTS'], settings['RUN_TIME'], settings['GIVE_UP_TIME'], table, identify, clock=clock, log=quiet)
+        elif meta.get('board_cleared'):
+            machine.reset() # reset from the GUI since the robot's last request
+        machine.tick()
+        machine.running = state.get('running', True)
+        t = time.time()
+        action = machine.decide_action(request)
+        decisions.append((action, time.time() - t))
+        if action != meta['response']['action']:
+            mismatches.append((n, state.get('phase', machine.phase_name), meta['response']['action'], action))
+    elapsed = time.time() - start
+    return {
+        'records' : len(reader),
+        'elapsed' : elapsed,
+        'decisions_per_second' : len(decisions) / elapsed if elapsed else 0.0,
+        'latency_ms' : by_action(decisions),
+        'mismatches' : mismatches
+    }
+
+# Reporting
+def by_action(decisions):
+    latencies = {}
+    for (action, dt) in decisions:
+        latencies.setdefault(action, []).append(dt)
+    return dict((action, dict(percentiles(t), count=len(t))) for (action, t) in latencies.items())
+
+def report(result):
+    if 'runs' in result:
+        print('Runs: %d (%d finished), %d decisions in %.2f s' % (result['runs'], result['finished'], result['decisions'], result['elapsed']))
+        print('Per run: %.1f plants, %.1f correct, %.1f samples, %.0f s virtual (p90 %.0f s)' % (result['plants'], result['correct'], result['samples'], result['virtual_time']['mean'], result['virtual_time']['p90']))
+    else:
+        print('Records: %d, %d decisions differ from the recording' % (result['records'], len(result['mismatches'])))
+        for (n, phase, recorded, action) in result['mismatches'][:10]:
+            print('    #%d (%s): recorded %s, replayed %s' % (n, phase, recorded, action))
+    print('Throughput: %.0f decisions/s' % result['decisions_per_second'])
+    print('Latency (ms)      count     mean      p50      p99')
+    for (action, t) in sorted(result['latency_ms'].items()):
+        print('    %-10s %8d %8.3f %8.3f %8.3f' % (action, t['count'], t['mean'], t['p50'], t['p99']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay or simulate the competition strategy')
+    parser.add_argument('config', help='settings file, e.g. configs/settings.json')
+    parser.add_argument('--images', default='test/logitech', help='directory of labelled images for the virtual field')
+    parser.add_argument('--runs', type=int, default=100, help='virtual runs to simulate')
+    parser.add_argument('--record', help='replay this recorded run directory instead of simulating')
+    parser.add_argument('--strategy', help='rules file, defaults to STRATEGY_PATH')
+    parser.add_argument('--oracle', action='store_true', help='identify plants from their labels instead of the classifier')
+    parser.add_argument('--burst', type=int, default=1, help='frames per plant')
+    parser.add_argument('--latency', type=float, default=0.1, help='virtual seconds per server round trip')
+    parser.add_argument('--seed', type=int, help='seed for the virtual fields')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    with open(args.config) as config:
+        settings = json.loads(config.read())
+    table = compile_rules(load_rules(args.strategy or settings['STRATEGY_PATH']), settings['ACTIONS'].keys())
+    corpus = load_corpus(args.images)
+    if args.oracle:
+        labels = dict((id(bgr), truth) for (name, truth, bgr) in corpus)
+        identify = lambda frames: labels.get(id(frames[-1]), ('green', 'short')) + (1.0, frames[-1])
+    else:
+        classifier = vision.load_classifier(args.config)
+        identify = classifier.classify_burst
+    if args.record:
+        result = replay_record(settings, table, args.record, identify)
+    else:
+        result = simulate(settings, table, corpus, identify, args.runs, args.latency, args.burst, args.seed)
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=4, sort_keys=True)
@@ -7,16 +7,20 @@ __version__ = "0.1"
 
 # Libraries
 import zmq
-import ast
 import json
 import os
 import sys
 import time
 import numpy as np
+import threading
+import Queue
 from datetime import datetime
+from socket import gethostname
 from serial import Serial, SerialException
 import cv2, cv
-import thread
+from metrics import Metrics, NullMetrics
+import protocol
+from ecu_sim import VirtualECU
 
 # Constants
 try:
@@ -24,6 +28,78 @@ try:
 except Exception as err:
     exit()
 
+# Camera frames
+class FrameRing(object):
+    """
+    Preallocated ring of frames which the capture thread reads into in place -
+    Readers pin the slots they are using and the writer never reuses a
+    pinned slot, so frames are shared without copies and are never torn
+    """
+
+    ## Initialize
+    def __init__(self, slots, height, width):
+        self.frames = np.zeros((slots, height, width, 3), np.uint8)
+        self.seq = [0] * slots # sequence number of the frame in each slot, 0 while empty or being written
+        self.stamps = [0.0] * slots # capture times
+        self.pins = [0] * slots
+        self.head = -1 # slot of the newest frame
+        self.captured = 0
+        self.dropped = 0
+        self.fps = 0.0
+        self.lock = threading.Lock()
+        self.captures = threading.Condition(self.lock) # notified on every commit
+
+    ## Writer
+    def writable(self):
+        """ Claim the oldest unpinned slot for the next frame, or None if all are pinned """
+        with self.lock:
+            n = len(self.seq)
+            for i in range(1, n + 1):
+                slot = (self.head + i) % n
+                if self.pins[slot] == 0:
+                    self.seq[slot] = 0
+                    return slot
+    def commit(self, slot, stamp):
+        with self.lock:
+            if self.head >= 0 and stamp > self.stamps[self.head]:
+                self.fps = 0.9 * self.fps + 0.1 / (stamp - self.stamps[self.head])
+            self.captured += 1
+            self.seq[slot] = self.captured
+            self.stamps[slot] = stamp
+            self.head = slot
+            self.captures.notify_all()
+    def drop(self):
+        with self.lock:
+            self.dropped += 1
+
+    ## Readers
+    def acquire(self, count=1, step=1, since=None, timeout=0.0):
+        """
+        Pin up to count frames, every step-th going back from the newest.
+        With since, only frames captured after that time are taken, waiting
+        up to timeout seconds for count of them to arrive.
+        Returns [(seq, stamp, frame)] oldest first; call release() when done.
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                slots = sorted((s for s in range(len(self.seq)) if self.seq[s] and (since is None or self.stamps[s] > since)), key=lambda s: -self.seq[s])
+                slots = slots[::step][:count]
+                remaining = deadline - time.time()
+                if len(slots) == count or remaining <= 0:
+                    break
+                self.captures.wait(remaining)
+            for s in slots:
+                self.pins[s] += 1
+            return [(self.seq[s], self.stamps[s], self.frames[s]) for s in reversed(slots)]
+    def release(self, snapshot):
+        with self.lock:
+            for (seq, stamp, frame) in snapshot:
+                self.pins[self.seq.index(seq)] -= 1
+
+# Status fields a speculative request is validated against
+PREDICTED_FIELDS = ('command', 'result', 'at_plant', 'at_end', 'pass_num')
+
 # Robot
 class Robot:
 
@@ -34,6 +110,8 @@ class Robot:
         self.load_config(config_path)
 
         # Initializers
+        self.stats = Metrics() if self.METRICS_ENABLED else NullMetrics()
+        self.pipeline_saved = 0.0 # seconds, a miss costs what it waited so this can go down
         try:
             self.init_zmq()
             self.init_arduino()
@@ -44,6 +122,10 @@ class Robot:
     ## Close
     def close(self):
         self.pretty_print('WARN', 'Shutdown triggered!')
+        self.pretty_print('STATS', json.dumps(self.stats.snapshot()))
+        if self.ROBOT_PIPELINE:
+            counters = self.stats.snapshot()['counters']
+            self.pretty_print('STATS', 'Pipeline saved %.1f s (%d hits, %d misses)' % (self.pipeline_saved, counters.get('speculation_hits', 0), counters.get('speculation_misses', 0)))
         sys.exit()
     
     ## Pretty Print
@@ -66,6 +148,7 @@ class Robot:
         try:
             self.context = zmq.Context()
             self.socket = self.context.socket(zmq.REQ)
+            self.socket.setsockopt(zmq.IDENTITY, str(self.ROBOT_ID or gethostname())) # the server keeps one session per identity
             self.socket.connect(self.ZMQ_ADDR)
             self.poller = zmq.Poller()
             self.poller.register(self.socket, zmq.POLLIN)
@@ -78,23 +161,58 @@ class Robot:
         if self.VERBOSE: self.pretty_print("CTRL", "Initializing Arduino ...")        
         try:
             self.arduino = Serial(self.ARDUINO_DEV, self.ARDUINO_BAUD, timeout=self.ARDUINO_TIMEOUT)
-            time.sleep(wait)
+            self.binary = False # text statuses until binary framing is negotiated
+            self.replies = Queue.Queue() # decoded statuses (or decoding errors) from the controller
+            self.serial_thread = threading.Thread(target=self.read_serial, name='serial')
+            self.serial_thread.daemon = True
+            self.serial_thread.start()
+            time.sleep(wait) # board resets when the port opens
+            if self.ARDUINO_PROTOCOL == 'binary':
+                self.execute_command('binary') # older sketches answer '?' and stay on text
+                self.pretty_print('CTRL', 'Protocol: %s at %d baud' % ('binary' if self.binary else 'text', self.arduino.baudrate))
         except Exception as e:
             self.pretty_print('CTRL', 'Error: %s' % str(e))
             raise e
     
+    ## Read statuses from the controller
+    def read_serial(self):
+        partial = ''
+        while True:
+            try:
+                if self.binary:
+                    self.replies.put(protocol.read_frame(self.arduino.read))
+                    continue
+                partial += self.arduino.readline() # may return early on the port timeout
+                if not partial.endswith('\n'):
+                    continue
+                (line, partial) = (partial, '')
+                status = protocol.decode_text(line)
+                if status.get('command') == protocol.BINARY_COMMAND:
+                    self.arduino.baudrate = self.ARDUINO_FAST_BAUD # the sketch switches once this reply is flushed
+                    self.binary = True
+                self.replies.put(status)
+            except (SyntaxError, ValueError) as e:
+                self.replies.put(e) # garbled, the waiting command asks for a repeat
+            except Exception as e:
+                self.pretty_print('CTRL', 'Error: %s' % str(e))
+                self.replies.put(None) # wake up a waiting command
+                return
+
     ## Initialize camera
     def init_cam(self):
         if self.VERBOSE: self.pretty_print("CTRL", "Initializing Cameras ...")
         try:
-            self.bgr = np.zeros((self.CAMERA_HEIGHT, self.CAMERA_WIDTH, 3))
+            self.blank = np.zeros((self.CAMERA_HEIGHT, self.CAMERA_WIDTH, 3), np.uint8)
+            self.ring = FrameRing(self.CAMERA_BUFFER_SIZE, self.CAMERA_HEIGHT, self.CAMERA_WIDTH)
             self.camera = cv2.VideoCapture(self.CAMERA_INDEX)
             self.camera.set(cv.CV_CAP_PROP_FRAME_WIDTH, self.CAMERA_WIDTH)
             self.camera.set(cv.CV_CAP_PROP_FRAME_HEIGHT, self.CAMERA_HEIGHT)
             self.camera.set(cv.CV_CAP_PROP_SATURATION, self.CAMERA_SATURATION)
             self.camera.set(cv.CV_CAP_PROP_CONTRAST, self.CAMERA_CONTRAST)
             self.camera.set(cv.CV_CAP_PROP_BRIGHTNESS, self.CAMERA_BRIGHTNESS)
-            thread.start_new_thread(self.capture_image, ())
+            self.capture_thread = threading.Thread(target=self.capture_image, name='capture')
+            self.capture_thread.daemon = True
+            self.capture_thread.start()
         except Exception as e:
             self.pretty_print('CAM', 'Error: %s' % str(e))
             raise e
@@ -103,36 +221,88 @@ class Robot:
     def capture_image(self):
         if self.VERBOSE: self.pretty_print("CTRL", "Capturing image ...")
         while True:
-            time.sleep(0.01)
-            (s, bgr) = self.camera.read()
+            slot = self.ring.writable()
+            if slot is None: # every slot pinned by readers
+                self.ring.drop()
+                time.sleep(0.01)
+                continue
+            frame = self.ring.frames[slot]
+            with self.stats.span('capture'):
+                (s, bgr) = self.camera.read(frame) # decodes in place when the size matches
+                if s and bgr is not frame:
+                    cv2.resize(bgr, (self.CAMERA_WIDTH, self.CAMERA_HEIGHT), frame)
             if s:
-                self.bgr = bgr
+                self.ring.commit(slot, time.time())
             else:
-                self.bgr = np.zeros((self.CAMERA_HEIGHT, self.CAMERA_WIDTH, 3))
+                self.ring.drop()
+                time.sleep(0.01)
     
+    ## Encode frame for transport
+    def encode_frame(self, bgr):
+        """
+        Returns the header fields and payload describing a frame for the
+        configured ZMQ_FRAME_ENCODING (raw, jpeg or json)
+        """
+        bgr = np.asarray(bgr, np.uint8)
+        if self.ZMQ_FRAME_ENCODING == 'jpeg':
+            (s, jpg) = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, self.ZMQ_JPEG_QUALITY])
+            if s:
+                return {'encoding' : 'jpeg'}, jpg.tostring()
+        elif self.ZMQ_FRAME_ENCODING == 'json':
+            return {'bgr' : bgr.tolist()}, None
+        bgr = np.ascontiguousarray(bgr)
+        return {'encoding' : 'raw', 'shape' : bgr.shape, 'dtype' : str(bgr.dtype)}, bgr
+
     ## Send request to server
-    def request_action(self, status):
+    def request_action(self, status, speculative=False, confirmed=False):
         if self.VERBOSE: self.pretty_print('ZMQ', 'Pushing request to server ...')
+        snapshot = []
+        if status['at_plant'] and self.ZMQ_FRAME_ENCODING != 'json' and not speculative:
+            # several views of the plant for the server to vote on, all taken since the robot stopped at it
+            snapshot = self.ring.acquire(self.CAMERA_BURST_FRAMES, since=status.get('received'), timeout=self.CAMERA_BURST_TIMEOUT)
+            self.stats.observe('burst_frames', len(snapshot))
+        if not snapshot:
+            snapshot = self.ring.acquire()
         try:
             last_action = [key for key, value in self.ACTIONS.iteritems() if value == status['command']][0]
-            bgr = self.bgr
             request = {
                 'type' : 'request',
                 'last_action' : last_action,
                 'result' : status['result'],
                 'at_end' : status['at_end'],
                 'at_plant' : status['at_plant'],
-                'pass_num' : status['pass_num'],
-                'bgr' : bgr.tolist()
+                'pass_num' : status['pass_num']
             }
+            if speculative:
+                request['speculative'] = True # sent with a predicted status while the last action runs
+            if confirmed:
+                request['confirmed'] = True # the last action came from the speculative response, the server commits it
+            if snapshot:
+                frames = [frame for (seq, stamp, frame) in snapshot]
+                age = time.time() - snapshot[-1][1]
+                self.stats.observe('frame_age', age)
+                self.stats.gauge('capture_fps', self.ring.fps)
+                self.stats.gauge('frames_dropped', self.ring.dropped)
+                if self.VERBOSE: self.pretty_print('CAM', 'Frame %d, %.3f s old (%.1f fps, %d dropped)' % (snapshot[-1][0], age, self.ring.fps, self.ring.dropped))
+            else:
+                frames = [self.blank] # nothing captured yet
+            with self.stats.span('encode'):
+                encoded = [self.encode_frame(f) for f in frames]
+            (fields, frame) = encoded[0]
+            request.update(fields)
             dump = json.dumps(request)
-            self.socket.send(dump)
-            socks = dict(self.poller.poll(self.ZMQ_TIMEOUT))
-            if socks:
+            with self.stats.span('rtt'): # includes timeouts
+                if frame is None:
+                    self.socket.send(dump) # legacy single-part JSON
+                else:
+                    self.socket.send_multipart([dump] + [frame for (fields, frame) in encoded], copy=False)
+                socks = dict(self.poller.poll(self.ZMQ_TIMEOUT))
                 if socks.get(self.socket) == zmq.POLLIN:
                     dump = self.socket.recv(zmq.NOBLOCK)
+            if socks:
+                if socks.get(self.socket) == zmq.POLLIN:
                     response = json.loads(dump)
-                    self.pretty_print('ZMQ', 'Response: %s' % str(response))
+                    if self.VERBOSE: self.pretty_print('ZMQ', 'Response: %s' % str(response))
                     try:
                         action = response['action']
                         self.pretty_print('ZMQ', 'Action: %s' % str(action))
@@ -145,34 +315,107 @@ class Robot:
                 self.pretty_print('ZMQ', 'Error: Socket Timeout')
         except Exception as e:
             raise e
+        finally:
+            self.ring.release(snapshot) # only once the reply shows the frames were sent
 
     ## Exectute robotic action
-    def execute_command(self, action, attempts=5, wait=2.0):
+    def execute_command(self, action):
+        """
+        Send the action's command and return as soon as its status line
+        arrives; if nothing arrives within the action's timeout, or the line
+        is unreadable, the controller is asked to repeat its last status
+        """
         if self.VERBOSE: self.pretty_print('CTRL', 'Interacting with controller ...')
         try:
             command = self.ACTIONS[action]
+            timeout = self.ARDUINO_TIMEOUTS.get(action, self.ARDUINO_TIMEOUT)
             self.pretty_print("CTRL", "Command: %s" % str(command))
+            while not self.replies.empty():
+                self.replies.get_nowait() # stale replies, e.g. to an earlier repeat
+            start = time.time()
             self.arduino.write(str(command)) # send command
-            time.sleep(wait)
             status = {}
+            retries = 0
             while status == {}:
                 try:
-                    string = self.arduino.readline()
-                    status = ast.literal_eval(string) # parse status response
-                except SyntaxError as e:
-                    self.pretty_print('CTRL', 'Error: %s (%s)' % (str(e), string))
-                    time.sleep(wait)
-                except ValueError as e:
-                    self.pretty_print('CTRL', 'Error: %s (%s)' % (str(e), string))
-                    self.pretty_print("CTRL", "Requesting repeat of last command ...")
-                    self.arduino.write(str(self.ACTIONS['repeat'])) # send command
-                    time.sleep(wait)
+                    with self.stats.span('serial_wait'):
+                        status = self.replies.get(timeout=timeout)
+                    if status is None:
+                        raise SerialException('Serial reader stopped')
+                    if isinstance(status, Exception):
+                        raise status
+                    if status.get('command') != command:
+                        self.pretty_print('CTRL', 'Ignoring stale status: %s' % status)
+                        status = {}
+                    continue
+                except Queue.Empty:
+                    self.stats.inc('serial_timeouts')
+                    self.pretty_print('CTRL', 'Error: No status after %.1f s' % timeout)
+                except (SyntaxError, ValueError) as e:
+                    status = {}
+                    self.stats.inc('serial_errors')
+                    self.pretty_print('CTRL', 'Error: %s' % str(e))
+                if retries == self.ARDUINO_RETRIES:
+                    raise SerialException('No status after %d repeats of %s' % (retries, command))
+                self.pretty_print("CTRL", "Requesting repeat of last command ...")
+                self.arduino.write(str(self.ACTIONS['repeat'])) # send command
+                self.stats.inc('serial_retries')
+                retries += 1
+            self.stats.observe('serial_%s' % action, time.time() - start)
+            status['received'] = time.time() # frames captured after this show where the robot stopped
             self.pretty_print("CTRL", "Status: %s" % status)
             self.last_action = action
             return status
         except Exception as e:
             self.pretty_print('CTRL', 'Error: %s' % str(e))
 
+    ## Predict the controller status after an action succeeds
+    def predict_status(self, action, status):
+        ecu = VirtualECU()
+        for key in PREDICTED_FIELDS:
+            setattr(ecu, key, status[key])
+        ecu.execute(self.ACTIONS[action])
+        return ecu.status()
+
+    ## Execute an action while requesting the next one
+    def pipeline(self, action, status):
+        """
+        For actions whose outcome is predictable (ROBOT_PIPELINE_ACTIONS), the
+        next request is sent with the predicted status while the controller
+        is still moving. Returns the real status and, if it matched the
+        prediction, the next action so the round trip is skipped; the server
+        holds that decision until the following request confirms it.
+        """
+        if action not in self.ROBOT_PIPELINE_ACTIONS:
+            return (self.execute_command(action), None)
+        predicted = self.predict_status(action, status)
+        speculation = {}
+        def speculate():
+            start = time.time()
+            try:
+                speculation['action'] = self.request_action(predicted, speculative=True)
+            except Exception as e:
+                self.pretty_print('PIPE', 'Error: %s' % str(e))
+            speculation['elapsed'] = time.time() - start
+        thread = threading.Thread(target=speculate, name='speculate')
+        thread.daemon = True
+        thread.start()
+        status = self.execute_command(action)
+        start = time.time()
+        thread.join() # one request at a time on the REQ socket
+        waited = time.time() - start
+        hit = status and all(status.get(key) == predicted[key] for key in PREDICTED_FIELDS)
+        saved = speculation['elapsed'] - waited if hit else -waited
+        self.pipeline_saved += saved
+        self.stats.gauge('pipeline_saved', self.pipeline_saved) # a gauge, counters must not decrease
+        if hit:
+            self.stats.inc('speculation_hits')
+            if self.VERBOSE: self.pretty_print('PIPE', 'Prefetched %s after %s, saved %.3f s' % (speculation.get('action'), action, saved))
+            return (status, speculation.get('action'))
+        self.stats.inc('speculation_misses')
+        self.pretty_print('PIPE', 'Speculation after %s missed: %s' % (action, status))
+        return (status, None)
+
     ## Run
     def run(self):
         status = {
@@ -182,11 +425,19 @@ class Robot:
             'command' : '?',
             'result' : 255
         }
+        action = None
+        prefetched = False # action came from a speculative response, confirmed by the next request
         while True:
             try:
-                action = self.request_action(status)
+                if action is None:
+                    action = self.request_action(status, confirmed=prefetched)
+                    prefetched = False
                 if action:
-                    status = self.execute_command(action) #!TODO handle different responses
+                    if self.ROBOT_PIPELINE and not prefetched: # one unconfirmed speculation at a time
+                        (status, action) = self.pipeline(action, status)
+                        prefetched = action is not None
+                    else:
+                        (status, action) = (self.execute_command(action), None) #!TODO handle different responses
             except Exception as e:
                 self.pretty_print('RUN', 'Error: %s' % str(e))
                 self.close()
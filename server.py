@@ -21,20 +21,88 @@ from pymongo import MongoClient
 from bson import json_util
 import zmq
 import cv2, cv
-import pygtk
-pygtk.require('2.0')
-import gtk
-import matplotlib.pyplot as mpl
 import time
+import Queue
+import hashlib
+import mimetypes
+import subprocess
+import threading
+import multiprocessing
 from random import randint
+from functools import partial
+from metrics import Metrics, NullMetrics
+from storage import EventWriter, MongoBackend, FileBackend, RunRecorder
+from strategy import StateMachine, compile_rules, load_rules, DEBUG, INFO
+from vision import PlantClassifier, ClassifierPool, vote
 
 # Configuration
+WORKERS_ADDR = 'inproc://workers'
 try:
     CONFIG_PATH = sys.argv[1]
 except Exception as err:
     print "NO CONFIGURATION FILE GIVEN"
     exit(1)
 
+# Robot session
+class Session(object):
+    """ Run state of one robot, keyed by the identity of its ZMQ socket """
+
+    ## Initialize
+    def __init__(self, identity=None):
+        self.identity = None
+        self.name = None
+        self.machine = None
+        self.lock = threading.Lock() # one decision at a time per robot
+        self.requests = 0
+        self.last_seen = None
+        self.recorded_version = 0 # board version in the run log
+        if identity is not None:
+            self.claim(identity)
+    def claim(self, identity):
+        """ Assign the session to a robot """
+        self.identity = identity
+        self.name = identity.encode('hex') if identity.startswith('\x00') else identity # zmq generates \x00-prefixed identities
+
+# Live updates
+class Broadcast(object):
+    """
+    Fans each item out to every subscriber's bounded queue - a subscriber
+    that falls behind loses its oldest items and is flagged as lagged,
+    instead of buffering without limit or slowing the publisher
+    """
+
+    ## Initialize
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.subscribers = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    ## Subscribe
+    def subscribe(self):
+        q = Queue.Queue(self.queue_size)
+        q.lagged = False
+        with self.lock:
+            self.subscribers = self.subscribers + [q]
+        return q
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not q]
+
+    ## Publish
+    def publish(self, item):
+        for q in self.subscribers:
+            try:
+                q.put_nowait(item)
+            except Queue.Full:
+                try:
+                    q.get_nowait()
+                except Queue.Empty:
+                    pass
+                q.put_nowait(item) # only this thread puts, so there is room now
+                q.lagged = True
+                self.dropped += 1
+
 # CherryPy3 server
 class Server:
     
@@ -42,13 +110,20 @@ class Server:
     def __init__(self, config_path):
         
         # Configuration
+        self.config_path = config_path
         self.load_config(config_path)
         
         # Initializers
+        self.stats = Metrics() if self.METRICS_ENABLED else NullMetrics()
+        self.gui_stats = NullMetrics() # the GUI process's own, see control()
+        self.__init_cv__() # fork classifier workers before any other threads start
         self.__init_zmq__()
         self.__init_tasks__()
         self.__init_mongo__()
+        self.__init_recorder__()
         self.__init_statemachine__()
+        self.__init_api__()
+        self.__init_streams__()
         self.__init_gui__()
 
     ## Useful Functions
@@ -70,47 +145,122 @@ class Server:
     ## Mongo Functions
     def __init_mongo__(self):
         if self.VERBOSE: self.pretty_print('MONGO', 'Initializing Mongo')
+        self.writer = None
+        if not self.MONGO_ENABLED:
+            return
         try:
-            self.mongo_client = MongoClient(self.MONGO_ADDR, self.MONGO_PORT)
+            if self.MONGO_BACKEND == 'file':
+                backend = FileBackend(self.MONGO_FILE_DIR)
+            else:
+                self.mongo_client = MongoClient(self.MONGO_ADDR, self.MONGO_PORT)
+                backend = MongoBackend(self.mongo_client)
+            self.writer = EventWriter(backend, self.stats, self.MONGO_DB, self.MONGO_COL,
+                frames_collection=self.MONGO_FRAMES_COL,
+                time_format=self.TIME_FORMAT,
+                queue_size=self.MONGO_QUEUE_SIZE,
+                batch_size=self.MONGO_BATCH_SIZE,
+                interval=self.MONGO_FLUSH_INTERVAL,
+                policy=self.MONGO_DROP_POLICY,
+                jpeg_quality=self.MONGO_JPEG_QUALITY)
+            cherrypy.engine.subscribe('exit', self.writer.close) # flush queued events
         except Exception as error:
             self.pretty_print('MONGO', 'Error: %s' % str(error))
-    def store_event(self, request, response, collection_name=''):
-        if self.VERBOSE: self.pretty_print('MONGO', 'Storing Sample')
+
+    ## Run Log Functions
+    def __init_recorder__(self):
+        self.recorder = None
+        self.recorder_lock = threading.Lock()
+        if not self.RECORD_ENABLED:
+            return
         try:
-            timestamp = datetime.strftime(datetime.now(), self.TIME_FORMAT)
-            collection_name = datetime.strftime(datetime.now(), self.MONGO_COL) # db to save to
-            db_name = datetime.strftime(datetime.now(), self.MONGO_DB) # db to save to
-            mongo_db = self.mongo_client[db_name]
-            collection = mongo_db[collection_name]
-            event = {
-                'request' : request,
-                'response' : response,
-                'time' : timestamp
-            } 
-            event_id = collection.insert(event)
-            self.pretty_print('MONGO', 'Sample ID: %s' % str(event_id))
-            return str(event_id)
+            path = os.path.join(self.CHERRYPY_DATA_DIR, 'runs', datetime.strftime(datetime.now(), '%Y%m%d_%H%M%S'))
+            self.recorder = RunRecorder(path, self.RECORD_SEGMENT_SIZE)
+            cherrypy.engine.subscribe('exit', self.recorder.close)
+            self.pretty_print('RECORD', 'Recording run to %s' % path)
         except Exception as error:
-            self.pretty_print('MONGO', 'Error: %s' % str(error))
+            self.pretty_print('RECORD', 'Error: %s' % str(error))
+    def record_event(self, session, request, response, arrived, service_time):
+        """ Append the request metadata, decision and received frame parts to the run log """
+        header = dict((k, v) for (k, v) in request.items() if k not in ('bgr', 'frames', 'payloads'))
+        parts = request['payloads']
+        if not parts: # legacy JSON frame, kept raw
+            frame = request['bgr']
+            header.update(encoding='raw', shape=frame.shape, dtype=str(frame.dtype))
+            parts = [frame.tostring()]
+        machine = session.machine
+        if request.get('speculative') and machine.speculation:
+            machine = machine.speculation # the copy the request was decided on
+        meta = {
+            'request' : header,
+            'response' : response,
+            'service_time' : service_time,
+            'state' : {
+                'running' : machine.running,
+                'phase' : machine.phase_name,
+                'row_num' : machine.row_num,
+                'plant_num' : machine.plant_num,
+                'samples_num' : machine.samples_num
+            }
+        }
+        board = session.machine.board
+        meta['board'] = [p.snapshot() for p in board.changed_since(session.recorded_version)] # votes since the last record
+        if board.cleared > session.recorded_version:
+            meta['board_cleared'] = True
+        session.recorded_version = board.version
+        with self.recorder_lock:
+            self.recorder.record(meta, parts, arrived)
        
     ## ZMQ Functions
     def __init_zmq__(self):      
+        """
+        Robots connect to a ROUTER socket, which tags each request with the
+        robot's identity; the serving loop passes requests on to a pool of
+        ZMQ_WORKERS threads over an inproc DEALER, and routes their replies
+        back. Run, Stop and Reset arrive on the control socket
+        """
         if self.VERBOSE: self.pretty_print('ZMQ', 'Initializing ZMQ')
+        self.controls = None
         try:
             self.context = zmq.Context()
-            self.socket = self.context.socket(zmq.REP)
+            self.socket = self.context.socket(zmq.ROUTER)
+            self.socket.setsockopt(zmq.ROUTER_HANDOVER, 1) # a robot reconnecting with its identity takes over its session
             self.socket.bind(self.ZMQ_HOST)
+            self.workers = self.context.socket(zmq.DEALER)
+            self.workers.bind(WORKERS_ADDR)
+            self.controls = self.context.socket(zmq.PULL)
+            self.controls.bind(self.GUI_CONTROL_ADDR)
         except Exception as error:
             self.pretty_print('ZMQ', str(error))
-    def receive_request(self):
+    def receive_request(self, parts):
+        """
+        Receive Request -
+        Requests are either a single JSON packet with the frame as a nested
+        list (legacy), or a JSON header followed by one raw/JPEG part per
+        frame; at a plant the robot sends a burst of recent frames
+        """
         if self.VERBOSE: self.pretty_print('ZMQ', 'Receiving request')
         try:
-            packet = self.socket.recv()
-            request = json.loads(packet)
+            request = json.loads(parts[0].bytes)
+            request['payloads'] = parts[1:] # encoded frames as received, for the run log
+            with self.stats.span('decode'):
+                if len(parts) > 1:
+                    request['frames'] = [self.decode_frame(request, part) for part in parts[1:]]
+                else:
+                    request['frames'] = [np.array(request['bgr'], np.uint8)]
+            request['bgr'] = request['frames'][-1] # most recent
             return request
         except Exception as error:
             self.pretty_print('ZMQ', 'Error: %s' % str(error))
-    def send_response(self, action):
+    def decode_frame(self, header, frame):
+        """ Decode a frame part without copying the received buffer """
+        buf = np.frombuffer(frame, np.uint8)
+        if header['encoding'] == 'jpeg':
+            return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+        elif header['encoding'] == 'raw':
+            return buf.view(header['dtype']).reshape(header['shape'])
+        else:
+            raise ValueError('Unknown frame encoding: %s' % header['encoding'])
+    def send_response(self, socket, envelope, action):
         """ Send Response """
         if self.VERBOSE: self.pretty_print('ZMQ', 'Sending Response to Robot')
         try:
@@ -119,258 +269,172 @@ class Server:
                 'action' : action
                 }
             dump = json.dumps(response)
-            self.socket.send(dump)
-            self.pretty_print('ZMQ', 'Response: %s' % str(response))
+            with self.stats.span('send'):
+                socket.send_multipart(envelope + [dump], copy=False)
+            if self.VERBOSE: self.pretty_print('ZMQ', 'Response: %s' % str(response))
             return response
         except Exception as error:
             self.pretty_print('ZMQ', str(error))   
     
     ## Statemachine Functions
     def __init_statemachine__(self):
-        self.bgr = cv2.imread(self.GUI_CAMERA_IMAGE)
-        self.running = False
-        self.row_num = 0
-        self.plant_num = 0
-        self.pass_num = 0
-        self.samples_num = 0
-        self.at_plant = 0
-        self.at_end = 0
-        self.start_time = time.time()
-        self.end_time = self.start_time + self.RUN_TIME
-        self.clock = self.end_time - self.start_time
-        self.observed_plants = [] #TODO can add dummy vals here
-        self.collected_plants = {
-            'green' : {
-                'short' : False,
-                'tall' : False                
-            },
-            'brown' : {
-                'short' : False,
-                'tall' : False                
-            },
-            'yellow' : {
-                'short' : False,
-                'tall' : False
-            }
-        }
-    def decide_action(self, request):
         """
-        Below is the Pseudocode for how the decisions are made:
-
-        start()
-        for row in range(4):
-            align()
-            while not at_end:
-                (at_end, at_plant, img) = seek
-                if at_plant: 
-                    (color, height, is_new) = identify_plant()
-                    if is_new: 
-                        grab()
-            turn()
-            align()
-            while not at_end:
-                (at_end, at_plant, img) = seek
-                if at_plant: 
-                    (color, height, is_new) = identify_plant()
-                    if is_new: 
-                        grab()
-            jump()
+        Each robot gets its own session, the GUI shows the first robot to
+        connect (until then, an idle session with no robot)
         """
-        self.pretty_print("DECIDE", "Last Action: %s" % request['last_action'])
-        self.pretty_print("DECIDE", "Result: %s" % request['result'])
-        self.pretty_print("DECIDE", "Row: %d" % self.row_num)
-        self.pretty_print("DECIDE", "Plants Observed: %d" % self.plant_num)
-        self.pretty_print("DECIDE", "Blocks Collected: %d" % self.samples_num)
-        self.at_end = request['at_end']
-        self.pass_num = request['pass_num']
-        self.at_plant = request['at_plant']
-        self.last_action = request['last_action']
-        self.pretty_print("DECIDE", "At End: %d" % self.at_end)
-        self.pretty_print("DECIDE", "At Plant: %d" % self.at_plant)
-        self.pretty_print("DECIDE", "Pass Num: %d" % self.pass_num)
-        ## If paused
-        if self.running == False:
-            if request['last_action'] == 'clear':
-                action = 'wait'
-            else:
-                action = 'clear'
-        ## If clock running out
-        elif self.clock <= self.GIVE_UP_TIME and (self.pass_num == 2): # if too little time
-            self.pretty_print("DECIDE", "Time almost up! Proceeding to end!")
-            if (self.last_action == 'finish') or (self.last_action == 'wait'):
-                action = 'wait'
-            elif self.at_end == 1:
-                action = 'finish'
-            else:
-                action = 'end'
-        ## If searching for plants 
-        elif (self.row_num <= self.NUM_ROWS) and (self.plant_num < self.NUM_PLANTS):
-            if self.row_num == 0:
-                action = 'begin' # begin if first action
-                self.row_num = 1
-            elif request['last_action'] == 'begin':
-                action = 'align' # align if jumped to beginning
-            elif request['last_action'] == 'align':
-                if (self.row_num in [1,2,3]) and (self.pass_num == 2):
-                    action = 'end' # seek to end/plant if aligned at end of row to search
-                else: 
-                    action = 'seek' # seek blindly if aligned at end of doubled row
-            elif request['last_action'] == 'seek' or request['last_action'] == 'end':
-                if request['at_end'] == 2:
-                    action = 'turn' # turn if at far end
-                elif request['at_end'] == 1:
-                    if self.row_num == self.NUM_ROWS:
-                        action = 'finish' # finish if at end of last row
-                        self.row_num = 0
-                    else:
-                        action = 'jump' # jump if at near end
-                        self.row_num = self.row_num + 1
-                elif request['at_plant'] != 0:
-                    (color, height, bgr2) = self.identify_plant(np.array(request['bgr'], np.uint8))
-                    self.pretty_print('DECIDE', 'Color: %s' % color)
-                    self.pretty_print('DECIDE', 'Height: %s' % height)
-                    self.bgr = bgr2
-                    if self.pass_num == 1:
-                        row = self.row_num
-                        plant = self.at_plant
-                    elif self.pass_num == 2:
-                        row = self.row_num + 1
-                        plant = 6 - self.at_plant # run plants backward
-                    s = self.add_plant(row, plant, color, height)
-                    if s: self.plant_num += 1
-                    if self.collected_plants[color][height] == True: # check if plant type has been seen yet
-                        action = 'seek'
-                    else:
-                        self.collected_plants[color][height] = True # if not, set to true and grab
-                        action = 'grab'
-                        self.samples_num += 1
+        self.bgr_version = 0
+        self.frame_cache = (None, None)
+        self.table = compile_rules(load_rules(self.STRATEGY_PATH), self.ACTIONS.keys()) # fails here if the strategy is incomplete
+        self.running = False # for sessions opened later
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.shown = self.new_session()
+        self.machine = self.shown.machine # on display
+        self.show_frame(cv2.imread(self.GUI_CAMERA_IMAGE))
+    def new_session(self, identity=None):
+        session = Session(identity)
+        session.machine = StateMachine(self.NUM_ROWS, self.NUM_PLANTS, self.RUN_TIME, self.GIVE_UP_TIME, self.table,
+            identify=partial(self.identify_plant, session),
+            defer=partial(self.defer_plant, session),
+            log=lambda task, msg: self.pretty_print(task, '%s: %s' % (session.name, msg)),
+            log_level=DEBUG if self.VERBOSE else INFO)
+        session.machine.running = self.running
+        return session
+    def open_session(self, identity):
+        """ Returns the robot's session, starting one on its first request """
+        try:
+            return self.sessions[identity]
+        except KeyError:
+            pass
+        with self.sessions_lock:
+            if identity not in self.sessions:
+                if self.sessions:
+                    session = self.new_session(identity)
                 else:
-                    action = 'seek'
-            elif request['last_action'] == 'turn':
-                action = 'align'
-            elif request['last_action'] == 'grab':
-                action = 'seek'
-            elif request['last_action'] == 'jump':
-                action = 'align'
-            else:
-                action = 'wait'
-        ## If at last row or reached 20 plants
-        else:
-            self.pretty_print("DECIDE", "20 plants and/or 4 rows! Proceeding to end!")
-            if self.last_action == 'finish':
-                action = 'wait'
-            if self.last_action == 'wait':
-                action = 'wait'
-            elif self.at_end == 2:
-                action = 'turn'
-            elif self.at_end == 1:
-                action = 'finish' # if part-way along final row (i.e. not at end #1)
-            elif self.at_end == 0:
-                action = 'end'
+                    session = self.shown # the first robot takes over the idle session on display
+                    session.claim(identity)
+                self.sessions[identity] = session
+                self.stats.gauge('sessions', len(self.sessions))
+                self.pretty_print('ZMQ', 'New session for robot %s' % session.name)
+            return self.sessions[identity]
+    def all_sessions(self):
+        """ The session on display and those of every other robot """
+        return [self.shown] + [session for session in self.sessions.values() if session is not self.shown]
+    def machines(self):
+        """ The state machine on display and those of every other robot """
+        return [session.machine for session in self.all_sessions()]
+    
+    ## Computer Vision Functions
+    def __init_cv__(self):
+        if self.VERBOSE: self.pretty_print('CV', 'Initializing Classifier')
+        self.pool = None
+        try:
+            args = (
+                self.CAMERA_THRESHOLDS[self.CAMERA_PROFILE],
+                self.CAMERA_CLASSIFIER,
+                self.CAMERA_TALL_THRESHOLD,
+                self.CHERRYPY_DATA_DIR,
+                self.CAMERA_ROI_SCALE,
+                self.CAMERA_ROI_MARGIN
+            )
+            self.classifier_args = args
+            self.classifiers = threading.local() # classifiers keep scratch buffers, one per thread
+            if self.CV_POOL_SIZE > 0:
+                shape = (self.CAMERA_HEIGHT, self.CAMERA_WIDTH, 3)
+                self.pool = ClassifierPool(args, self.CV_POOL_SIZE, shape)
+                cherrypy.engine.subscribe('exit', self.pool.close)
+        except Exception as error:
+            self.pretty_print('CV', 'Error: %s' % str(error))
+    def classify(self, frames):
+        """
+        Confidence-weighted vote over a burst of frames of one plant, each
+        frame is classified in the worker pool when there is one, the rest
+        in one batch on this thread
+        """
+        classifier = self.thread_classifier()
+        inline = []
+        queued = []
+        for bgr in frames:
+            slot = self.pool.submit(bgr) if self.pool else None
+            if slot is None:
+                inline.append(bgr)
             else:
-                action = 'wait' # if last plant was row 4, plant 5 (i.e. 20 plants in 20 positions)
-        return action
-    def identify_plant(self, bgr):
+                queued.append((slot, bgr))
+        results = classifier.score_batch(inline) if inline else []
+        if inline and self.stats.enabled:
+            for (stage, t) in classifier.timings.items():
+                self.stats.observe('cv_%s' % stage, t) # per request, summed over its frames
+        for (slot, bgr) in queued:
+            try:
+                (color, height, confidence, annotated, latency) = self.pool.wait(slot, self.CV_POOL_TIMEOUT)
+                self.stats.observe('cv_pool_latency', latency)
+                results.append((color, height, confidence, annotated))
+            except multiprocessing.TimeoutError:
+                self.stats.inc('cv_pool_timeouts') # collected later by reconcile_plants
+                results.append(classifier.score(bgr))
+            except Exception as error:
+                self.stats.inc('cv_pool_errors') # wait() has freed the slot, classify this frame here
+                if self.VERBOSE: self.pretty_print('CV', 'Pool error: %s' % str(error))
+                results.append(classifier.score(bgr))
+        (color, height, confidence, bgr) = vote(results)
+        if self.VERBOSE: self.pretty_print('CV', 'Vote: %s %s (%d frames, %.2f)' % (color, height, len(results), confidence))
+        return color, height, confidence, bgr
+    def thread_classifier(self):
+        try:
+            return self.classifiers.classifier
+        except AttributeError:
+            self.classifiers.classifier = PlantClassifier(*self.classifier_args)
+            return self.classifiers.classifier
+    def reconcile_plants(self):
+        """ Add plants classified in the background to the observed plants """
+        if self.pool is None:
+            return
+        for (context, color, height, confidence, bgr, latency) in self.pool.collect():
+            self.stats.observe('cv_pool_latency', latency)
+            if context is None or color is None:
+                continue # waited on (or failed) when it was submitted
+            (identity, row, plant) = context
+            session = self.sessions[identity]
+            if self.VERBOSE: self.pretty_print('CV', 'Reconciled %s %s plant at %d:%d for %s' % (color, height, row, plant, session.name))
+            self.show_frame(bgr, session)
+            with session.lock:
+                if session.machine.add_plant(row, plant, color, height, confidence): session.machine.plant_num += 1
+        self.stats.gauge('cv_queue_depth', self.pool.depth())
+    def show_frame(self, bgr, session=None):
+        """ Set the frame for the camera view, versioned so the GUI converts each frame once """
+        if session is not None and session is not self.shown:
+            return
+        self.bgr = bgr
+        self.bgr_version += 1
+    def frame_jpeg(self):
+        """ Returns (version, JPEG) of the frame on display, encoded once per version """
+        (version, jpg) = self.frame_cache
+        if version != self.bgr_version:
+            (version, bgr) = (self.bgr_version, self.bgr)
+            (s, buf) = cv2.imencode('.jpg', bgr)
+            jpg = buf.tostring() if s else None
+            self.frame_cache = (version, jpg)
+        return version, jpg
+    def defer_plant(self, session, request, row, plant):
+        """ Queue the plant for background classification, False if it must be identified now """
+        if self.pool and self.pool.submit(request['bgr'], (session.identity, row, plant)) is not None:
+            self.stats.inc('cv_deferred')
+            self.stats.gauge('cv_queue_depth', self.pool.depth())
+            return True
+        return False
+    def identify_plant(self, session, frames):
         """
+        Classify one or more frames of the plant
         Returns:
             color : green, yellow, brown
             height: short, tall
-            is_new : true/false
+            confidence : 0 to 1, 0 if guessed
+            bgr : blurred frame annotated with the plant's bounding box
         """
         if self.VERBOSE: self.pretty_print("CV2", "Identifying plant phenotype ...")
         try:
-            # Blur image
-            bgr = cv2.medianBlur(bgr, 5)
-            thin_kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(8,8))
-            fat_kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(10,10))
-            brown_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(10,10))
-            hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
-            detected_areas = [ (0,0,0,0) ] * 3
-            
-            ## Green
-            try:
-                green_low = np.array([25, 20, 5]) 
-                green_high = np.array([75, 255, 128])
-                green_mask = cv2.inRange(hsv, green_low, green_high)
-                green_invmask = cv2.bitwise_not(green_mask)
-                green_closed = cv2.morphologyEx(green_invmask, cv2.MORPH_CLOSE, thin_kernel)
-                green_eroded = cv2.erode(green_closed, fat_kernel)
-                green_output = cv2.bitwise_not(green_eroded)
-                ret,thresh = cv2.threshold(green_output, 127, 255, 0)
-                contours, hierarchy = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                areas = [cv2.contourArea(c) for c in contours]
-                max_index = np.argmax(areas) # Find the index of the largest contour
-                cnt = contours[max_index]
-                x,y,w,h = cv2.boundingRect(cnt)
-                detected_areas[0] = (x, y, w, h)
-            except Exception as e:
-                self.pretty_print('CV', 'Error: %s' % str(e))
-            
-            ## Yellow
-            try:
-                yellow_low = np.array([15, 128, 115])
-                yellow_high = np.array([35, 255, 255])
-                yellow_mask = cv2.inRange(hsv, yellow_low, yellow_high)
-                yellow_invmask = cv2.bitwise_not(yellow_mask)
-                yellow_closed = cv2.morphologyEx(yellow_invmask, cv2.MORPH_CLOSE, thin_kernel)
-                yellow_eroded = cv2.erode(yellow_closed, fat_kernel)
-                yellow_output = cv2.bitwise_not(yellow_eroded)
-                ret,thresh = cv2.threshold(yellow_output, 127, 255, 0)
-                contours, hierarchy = cv2.findContours(thresh, cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-                areas = [cv2.contourArea(c) for c in contours] 
-                max_index = np.argmax(areas) # Find the index of the largest contour
-                cnt = contours[max_index]
-                x,y,w,h = cv2.boundingRect(cnt)
-                detected_areas[1] = (x, y, w, h)
-            except Exception as e:
-                self.pretty_print('CV', 'Error: %s' % str(e))
-                
-            ## Brown
-            try:
-                brown_low_1 = np.array([0,0,0])
-                brown_high_1 = np.array([25,255,150])
-                brown_low_2 = np.array([160,0,0])
-                brown_high_2 = np.array([180,255,150])
-                brown_grey = cv2.cvtColor(bgr,cv2.COLOR_BGR2GRAY)
-                brown_mask_1 = cv2.inRange(hsv, brown_low_1, brown_high_1)
-                brown_mask_2 = cv2.inRange(hsv, brown_low_2, brown_high_2)
-                brown_mask = brown_mask_1 + brown_mask_2
-                brown_closed = cv2.morphologyEx(brown_mask, cv2.MORPH_CLOSE, brown_kernel)
-                brown_cut = cv2.bitwise_and(brown_grey, brown_closed)
-                brown_cut[brown_cut == 0] = 255
-                brown_thresh = cv2.threshold(brown_cut, 80, 255, cv2.THRESH_BINARY)[1]
-                brown_invmask = cv2.bitwise_not(brown_thresh)
-                brown_eroded = cv2.erode(brown_invmask, brown_kernel)
-                ret, thresh = cv2.threshold(brown_eroded, 127, 255, 0)
-                contours, hierarchy = cv2.findContours(thresh, cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-                areas = [cv2.contourArea(c) for c in contours] # Find the index of the largest contour
-                max_index = np.argmax(areas)
-                cnt = contours[max_index]
-                x,y,w,h = cv2.boundingRect(cnt)
-                detected_areas[2] = (x, y, w, h)
-            except Exception as e:
-                self.pretty_print('CV', 'Error: %s' % str(e))
-    
-            # Find most likely
-            areas = [w*h for (x, y, w, h) in detected_areas]
-            max_area = max(areas)
-            i = np.argmax(areas)
-            (x, y, w, h) = detected_areas[i]
-            if i == 0:
-                c = (0,255,0)
-                color = 'green'
-            elif i == 1:
-                c = (0,255,255)
-                color = 'yellow'
-            elif i == 2:
-                c = (0,87,115)
-                color = 'brown'
-            if h > self.CAMERA_TALL_THRESHOLD:
-                height = 'tall'
-            else:
-                height = 'short'
-            # bgr = np.dstack((brown_eroded, brown_eroded, brown_eroded)) # remove
-            cv2.rectangle(bgr,(x,y),(x+w,y+h), c, 2) # Draw the rectangle
+            with self.stats.span('identify'):
+                (color, height, confidence, bgr) = self.classify(frames)
         except Exception as e:
             self.pretty_print("CV", "ERROR: %s" % str(e))
             self.pretty_print("CV", "RANDOMLY ESTIMATING ...")
@@ -378,262 +442,417 @@ class Server:
             heights = ['tall', 'short']
             i = randint(0,2)
             j = randint(0,1)
-            color = color[i]
+            color = colors[i]
             height = heights[j]
-        return color, height, bgr
-    def add_plant(self, row, plant, color, height):
-        for p in self.observed_plants:
-            if p == (row, plant, color, height):
-                return False
-        self.observed_plants.append((row, plant, color, height))
-        return True
+            confidence = 0.0
+            bgr = frames[-1]
+        self.show_frame(bgr, session) # annotated with the detection
+        return color, height, confidence, bgr
  
     ## CherryPy Functions
     def __init_tasks__(self):
         if self.VERBOSE: self.pretty_print('CHERRYPY', 'Initializing Monitors')
         try:
-            Monitor(cherrypy.engine, self.listen, frequency=self.CHERRYPY_LISTEN_INTERVAL).subscribe()
+            self.serving = False
+            cherrypy.engine.subscribe('start', self.start_serving)
+            cherrypy.engine.subscribe('stop', self.stop_serving)
             Monitor(cherrypy.engine, self.refresh, frequency=self.CHERRYPY_REFRESH_INTERVAL).subscribe()
         except Exception as error:
             self.pretty_print('CHERRYPY', str(error))
-    def listen(self):
+    def start_serving(self):
+        """ Start the ZMQ serving loop and the worker pool in their own threads """
+        self.serving = True
+        self.serve_thread = threading.Thread(target=self.serve, name='zmq-serve')
+        self.serve_thread.daemon = True
+        self.serve_thread.start()
+        self.worker_threads = []
+        for n in range(self.ZMQ_WORKERS):
+            worker = threading.Thread(target=self.work, name='zmq-worker-%d' % n)
+            worker.daemon = True
+            worker.start()
+            self.worker_threads.append(worker)
+    def stop_serving(self):
+        self.serving = False
+    def serve(self):
+        """
+        Serve Requests -
+        Passes each request to the workers as soon as it is readable, with
+        its arrival time, and each reply back to its robot; the poll timeout
+        only bounds how long shutdown takes to notice
+        """
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.workers, zmq.POLLIN)
+        if self.controls:
+            poller.register(self.controls, zmq.POLLIN)
+        while self.serving:
+            try:
+                self.reconcile_plants()
+                socks = dict(poller.poll(self.ZMQ_POLL_INTERVAL))
+                if socks.get(self.socket) == zmq.POLLIN:
+                    parts = self.socket.recv_multipart(copy=False)
+                    self.workers.send_multipart(parts[:2] + [repr(time.time())] + parts[2:], copy=False)
+                if socks.get(self.workers) == zmq.POLLIN:
+                    self.socket.send_multipart(self.workers.recv_multipart(copy=False), copy=False)
+                if self.controls and socks.get(self.controls) == zmq.POLLIN:
+                    self.control(json.loads(self.controls.recv(zmq.NOBLOCK)))
+            except Exception as error:
+                self.pretty_print('ZMQ', 'Error: %s' % str(error))
+    def work(self):
+        """ Worker thread, decides requests from any robot """
+        socket = self.context.socket(zmq.DEALER)
+        socket.connect(WORKERS_ADDR)
+        while self.serving:
+            try:
+                if socket.poll(self.ZMQ_POLL_INTERVAL):
+                    self.listen(socket)
+            except Exception as error:
+                self.pretty_print('ZMQ', 'Error: %s' % str(error))
+        socket.close()
+    def listen(self, socket):
         """ Listen for Next Sample """
         if self.VERBOSE: self.pretty_print('CHERRYPY', 'Listening for nodes ...')
-        req = self.receive_request()
-        self.bgr = np.array(req['bgr'], np.uint8)
-        action = self.decide_action(req)
-        resp = self.send_response(action)
-        if self.MONGO_ENABLED: event_id = self.store_event(req, resp)
+        start = time.time()
+        parts = socket.recv_multipart(copy=False)
+        (envelope, arrived) = (parts[:2], float(parts[2].bytes)) # robot identity and delimiter, arrival time
+        self.stats.observe('queue_wait', start - arrived)
+        req = self.receive_request(parts[3:])
+        session = self.open_session(envelope[0].bytes)
+        req['robot'] = session.name
+        self.show_frame(req['bgr'], session)
+        with session.lock:
+            action = session.machine.decide_action(req)
+            session.requests += 1
+            session.last_seen = start
+            self.stats.observe('decision_time', session.machine.decision_time)
+        resp = self.send_response(socket, envelope, action)
+        self.stats.observe('service_time', time.time() - start)
+        self.stats.inc('requests')
+        if req.get('speculative'): self.stats.inc('speculative_requests')
+        if req.get('confirmed'): self.stats.inc('speculation_confirmed')
+        if self.writer:
+            with self.stats.span('store_event'):
+                self.writer.put(req, resp)
+        if self.recorder:
+            recorded = time.time()
+            self.record_event(session, req, resp, arrived, recorded - start)
+            self.stats.observe('record_time', time.time() - recorded)
     def refresh(self):
-        """ Update the GUI """
+        """ Count down every robot's clock and publish the state to the GUI """
         if self.VERBOSE: self.pretty_print('CHERRYPY', 'Updating GUI ...')
-        robot_position = (self.row_num, self.at_plant, self.pass_num, self.at_end)
-        self.gui.draw_camera(self.bgr)
-        self.gui.draw_board(self.observed_plants, robot_position)
-        if self.running:
-            self.clock = self.end_time - time.time()
-            if self.clock <= 0:
-                self.running = False
-        else:
-            self.end_time = time.time() + self.clock         
-        self.gui.update_gui(self.pass_num, self.row_num, self.plant_num, self.samples_num, self.clock)
+        for machine in self.machines():
+            machine.tick()
+        self.broadcast()
+        if self.publisher:
+            self.publish()
     @cherrypy.expose
     def index(self):
         """ Render index page """
-        html = open('static/index.html').read()
-        return html
+        return self.asset('index.html')
+    @cherrypy.expose
+    def metrics(self):
+        """ Every metric in the Prometheus text format, for scraping """
+        version = int(time.time() / self.CHERRYPY_REFRESH_INTERVAL)
+        return self.cached(('prometheus',), version, self.prometheus, 'text/plain; version=0.0.4')
     @cherrypy.expose
     def default(self, *args, **kwargs):
         """
-        Handle Posts -
-        This function is basically the RESTful API
+        Handle Gets -
+        This function is basically the RESTful API, anything else is a
+        static asset
+            /api/state[?robot=name]          run state
+            /api/plants[?robot=name&since=N] observed plants, changed since board version N
+            /api/frame.jpg                   latest (annotated) camera frame
+            /api/metrics                     server metrics (JSON, /metrics for Prometheus)
+        """
+        if args[:1] != ('api',):
+            return self.asset('/'.join(args))
+        endpoint = args[1] if len(args) == 2 else None
+        if endpoint == 'state':
+            return self.api_state(kwargs.get('robot'))
+        elif endpoint == 'plants':
+            return self.api_plants(kwargs.get('robot'), int(kwargs.get('since', -1)))
+        elif endpoint == 'frame.jpg':
+            return self.api_frame()
+        elif endpoint == 'metrics':
+            return self.api_metrics()
+        raise cherrypy.HTTPError(404)
+
+    ## REST API Functions
+    def __init_api__(self):
         """
+        Responses are cached by endpoint and rebuilt only when the version of
+        what they show changes, so polling costs a version check and, when
+        the client already has that body (If-None-Match), not even a body
+        """
+        self.responses = {} # key -> (version, etag, body, content type)
+        self.assets = {} # static file -> (mtime, etag, body, content type)
+        self.static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.CHERRYPY_STATIC_DIR)
+    def respond(self, etag, body, content_type):
+        """ Send the body, or 304 Not Modified if the client has it """
+        headers = cherrypy.response.headers
+        headers['ETag'] = etag
+        headers['Cache-Control'] = 'no-cache' # revalidate on every poll
+        headers['Content-Type'] = content_type
+        match = cherrypy.request.headers.get('If-None-Match', '')
+        if etag in [tag.strip() for tag in match.split(',')] or match.strip() == '*':
+            cherrypy.response.status = 304
+            return ''
+        return body
+    def cached(self, key, version, build, content_type='application/json'):
+        """ Respond with the cached body for key, rebuilding it with build() if version changed """
+        try:
+            (cached_version, etag, body, content_type) = self.responses[key]
+            if cached_version != version:
+                raise KeyError(key)
+        except KeyError:
+            body = build()
+            if content_type == 'application/json':
+                body = json.dumps(body, sort_keys=True)
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            self.responses[key] = (version, etag, body, content_type)
+        return self.respond(etag, body, content_type)
+    def asset(self, name):
+        """ Serve a file from the static directory, kept in memory until it changes on disk """
+        path = os.path.normpath(os.path.join(self.static_dir, name))
+        if not path.startswith(self.static_dir + os.sep) or not os.path.isfile(path):
+            raise cherrypy.HTTPError(404)
+        mtime = os.path.getmtime(path)
         try:
+            (cached_mtime, etag, body, content_type) = self.assets[path]
+            if cached_mtime != mtime:
+                raise KeyError(path)
+        except KeyError:
+            with open(path, 'rb') as f:
+                body = f.read()
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            self.assets[path] = (mtime, etag, body, content_type)
+        return self.respond(etag, body, content_type)
+    def find_session(self, robot):
+        """ The session of the named robot, or the one on display """
+        if robot is None:
+            return self.shown
+        for session in self.sessions.values():
+            if session.name == robot:
+                return session
+        raise cherrypy.HTTPError(404, 'No robot %s' % robot)
+    def state_snapshot(self, session):
+        m = session.machine
+        return {
+            'robot' : session.name,
+            'robots' : sorted(s.name for s in self.sessions.values()),
+            'running' : m.running,
+            'phase' : m.phase_name,
+            'clock' : round(m.clock, 1),
+            'last_action' : m.last_action,
+            'pass_num' : m.pass_num,
+            'row_num' : m.row_num,
+            'at_plant' : m.at_plant,
+            'at_end' : m.at_end,
+            'plant_num' : m.plant_num,
+            'samples_num' : m.samples_num,
+            'collected_plants' : m.collected_plants,
+            'board_version' : m.board.version,
+            'requests' : session.requests
+        }
+    def plants_snapshot(self, session, since=-1):
+        board = session.machine.board
+        return {
+            'robot' : session.name,
+            'version' : board.version,
+            'cleared' : board.cleared > since >= 0, # positions not listed may be gone
+            'plants' : [p.snapshot() for p in board.changed_since(since)]
+        }
+    def api_state(self, robot=None):
+        session = self.find_session(robot)
+        m = session.machine
+        state = (m.running, m.phase_name, round(m.clock, 1), m.last_action, m.pass_num, m.row_num, m.at_plant, m.at_end,
+                 m.plant_num, m.samples_num, m.board.version, session.requests, len(self.sessions))
+        return self.cached(('state', session.identity), state, lambda: self.state_snapshot(session))
+    def api_plants(self, robot=None, since=-1):
+        session = self.find_session(robot)
+        board = session.machine.board
+        build = lambda: self.plants_snapshot(session, since)
+        key = ('plants', session.identity, since < 0) # one entry for full lists, one for the latest since
+        return self.cached(key, (board.version, since), build)
+    def api_frame(self):
+        (version, jpg) = self.frame_jpeg()
+        if jpg is None:
+            raise cherrypy.HTTPError(404)
+        return self.cached(('frame',), version, lambda: jpg, 'image/jpeg')
+    def api_metrics(self):
+        version = int(time.time() / self.CHERRYPY_REFRESH_INTERVAL) # at most once per refresh
+        return self.cached(('metrics',), version, self.metrics_snapshot)
+    def metrics_snapshot(self):
+        return dict(self.stats.snapshot(), gui=self.gui_stats.snapshot())
+    def prometheus(self):
+        return self.stats.prometheus() + self.gui_stats.prometheus('gui_')
 
-            pass
-        except Exception as err:
-            self.pretty_print('ERROR', str(err))
-        return None
+    ## Streaming Functions
+    def __init_streams__(self):
+        """
+        Web viewers follow the robot on display over Server-Sent Events
+        (/events: state deltas and plant votes) and MJPEG (/frames.mjpg).
+        refresh() computes each update once and fans it out; every stream
+        holds one CherryPy thread, see CHERRYPY_THREAD_POOL
+        """
+        self.event_stream = Broadcast(self.CHERRYPY_STREAM_QUEUE)
+        self.frame_stream = Broadcast(2) # viewers only want the newest frame
+        self.streamed_state = {}
+        self.streamed_board = -1
+        self.streamed_frame = None
+    def broadcast(self):
+        """ Push what changed since the last refresh to the web viewers """
+        if self.event_stream.subscribers:
+            state = self.state_snapshot(self.shown)
+            delta = dict((k, v) for (k, v) in state.items() if self.streamed_state.get(k) != v)
+            if delta:
+                self.event_stream.publish(('state', json.dumps(delta)))
+            self.streamed_state = state
+            board = self.machine.board
+            if board.version != self.streamed_board:
+                self.event_stream.publish(('plants', json.dumps(self.plants_snapshot(self.shown, self.streamed_board))))
+                self.streamed_board = board.version
+        if self.frame_stream.subscribers and self.bgr_version != self.streamed_frame:
+            (version, jpg) = self.frame_jpeg()
+            if jpg is not None:
+                self.frame_stream.publish(self.mjpeg_part(jpg))
+            self.streamed_frame = version
+        self.stats.gauge('stream_viewers', len(self.event_stream.subscribers) + len(self.frame_stream.subscribers))
+        self.stats.gauge('stream_dropped', self.event_stream.dropped + self.frame_stream.dropped)
+    def sse(self, event, data):
+        return 'event: %s\ndata: %s\n\n' % (event, data)
+    def mjpeg_part(self, jpg):
+        return '--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (len(jpg), jpg)
+    @cherrypy.expose
+    def events(self):
+        """ Server-Sent Events, a full sync first (and after falling behind), then deltas """
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        def stream():
+            q = self.event_stream.subscribe()
+            try:
+                q.lagged = True
+                while self.serving:
+                    if q.lagged:
+                        q.lagged = False
+                        while not q.empty():
+                            q.get_nowait() # older than the sync
+                        yield self.sse('state', json.dumps(self.state_snapshot(self.shown)))
+                        yield self.sse('plants', json.dumps(dict(self.plants_snapshot(self.shown), cleared=True))) # replaces the viewer's board
+                    try:
+                        (event, data) = q.get(timeout=self.CHERRYPY_STREAM_KEEPALIVE)
+                        yield self.sse(event, data)
+                    except Queue.Empty:
+                        yield ': keepalive\n\n'
+            finally:
+                self.event_stream.unsubscribe(q) # also when the client goes away
+        return stream()
+    events._cp_config = {'response.stream' : True}
+    @cherrypy.expose
+    def frames_mjpg(self):
+        """ MJPEG stream of the frames on display, served at /frames.mjpg """
+        cherrypy.response.headers['Content-Type'] = 'multipart/x-mixed-replace; boundary=frame'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        def stream():
+            q = self.frame_stream.subscribe()
+            try:
+                (version, jpg) = self.frame_jpeg()
+                if jpg is not None:
+                    yield self.mjpeg_part(jpg)
+                while self.serving:
+                    try:
+                        yield q.get(timeout=self.CHERRYPY_STREAM_KEEPALIVE)
+                    except Queue.Empty:
+                        pass
+            finally:
+                self.frame_stream.unsubscribe(q)
+        return stream()
+    frames_mjpg._cp_config = {'response.stream' : True}
 
     ## GUI Functions
     def __init_gui__(self):
+        """
+        The GUI runs in its own process (gui.py) so rendering never competes
+        with decisions - it subscribes to state snapshots and sends the Run,
+        Stop and Reset buttons back on a control socket
+        """
+        self.publisher = None
+        self.published_version = None
+        self.published_time = 0.0 # when the frame was last sent
+        self.viewer = None
+        if not self.GUI_ENABLED:
+            return
         if self.VERBOSE: self.pretty_print('GUI', 'Initializing GUI')
         try:
-            self.gui = GUI(self)
-            self.running= False
+            self.publisher = self.context.socket(zmq.PUB)
+            self.publisher.setsockopt(zmq.SNDHWM, 2) # a slow GUI drops snapshots
+            self.publisher.setsockopt(zmq.XPUB_NODROP, 1) # raise zmq.Again on a full queue instead of dropping silently
+            self.publisher.bind(self.GUI_PUB_ADDR)
+            gui_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gui.py')
+            self.viewer = subprocess.Popen([sys.executable, gui_path, self.config_path])
+            cherrypy.engine.subscribe('exit', self.viewer.terminate)
         except Exception as error:
             self.pretty_print('GUI', str(error))
-    def run(self, object):
-        self.pretty_print("GUI", "Running session ...")
-        self.running = True
-    def stop(self, object):
-        self.pretty_print("GUI", "Halting session ...")
-        self.running = False
-    def reset(self, object):
-        self.pretty_print("GUI", "Resetting to start ...")
-        self.__init_statemachine__() # reset values
-    def close(self, widget, window):
-        try:
-            gtk.main_quit()
-        except Exception as e:
-            self.pretty_print('GUI', 'Console server is still up (CTRL-C to exit)')
-# Display
-class GUI(object):
-
-    ## Initialize Display
-    def __init__(self, object):
-        """
-        Requires super-object to have several handler functions:
-            - shutdown()
-            - close()
-            - reset()
-            - run()
-        """
-        try:
-            # CONSTANTS
-            self.GUI_LABEL_PASS = object.GUI_LABEL_PASS
-            self.GUI_LABEL_PLANTS = object.GUI_LABEL_PLANTS
-            self.GUI_LABEL_ROW = object.GUI_LABEL_ROW
-            self.GUI_LABEL_SAMPLES = object.GUI_LABEL_SAMPLES
-            self.GUI_LABEL_CLOCK = object.GUI_LABEL_CLOCK
-            self.GUI_BOARD_IMAGE = object.GUI_BOARD_IMAGE
-            # Window
-            self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
-            self.window.set_size_request(object.GUI_WINDOW_X, object.GUI_WINDOW_Y)
-            self.window.connect("delete_event", object.close)
-            self.window.set_border_width(10)
-            self.window.show()
-            self.hbox = gtk.HBox(False, 0)
-            self.window.add(self.hbox)
-            # Buttons
-            self.hbox2 = gtk.HBox(False, 0)
-            self.vbox = gtk.VBox(False, 0)
-            self.vbox2 = gtk.VBox(False, 0)
-            self.hbox.add(self.vbox)
-            self.hbox2.show()
-            self.vbox2.show()
-            self.hbox3 = gtk.HBox(False, 0)
-            self.vbox3 = gtk.VBox(False, 0)
-            self.button_run = gtk.Button("Run") # Run Button
-            self.button_run.connect("clicked", object.run)
-            self.vbox3.pack_start(self.button_run, True, True, 0)
-            self.button_run.show()
-            self.button_stop = gtk.Button("Stop") # Stop Button
-            self.button_stop.connect("clicked", object.stop)
-            self.vbox3.pack_start(self.button_stop, True, True, 0)
-            self.button_stop.show()
-            self.button_reset = gtk.Button("Reset") # Reset Button
-            self.button_reset.connect("clicked", object.reset)
-            self.hbox3.pack_start(self.button_reset, True, True, 0)
-            self.hbox3.add(self.vbox3)
-            self.vbox2.add(self.hbox3)
-            self.hbox3.show()
-            self.vbox3.show()
-            self.button_reset.show()
-            self.vbox.add(self.vbox2)
-            self.label_plants = gtk.Label()
-            self.label_plants.set(object.GUI_LABEL_PLANTS)
-            self.label_plants.show()		
-            self.vbox2.add(self.label_plants)
-            self.label_samples = gtk.Label()
-            self.label_samples.set(object.GUI_LABEL_SAMPLES)
-            self.label_samples.show()		
-            self.vbox2.add(self.label_samples)
-            self.label_row = gtk.Label()
-            self.label_row.set(object.GUI_LABEL_ROW)
-            self.label_row.show()
-            self.vbox2.add(self.label_row)
-            self.label_pass = gtk.Label()
-            self.label_pass.set(object.GUI_LABEL_PASS)
-            self.label_pass.show()		
-            self.vbox2.add(self.label_pass)
-            self.label_clock = gtk.Label()
-            self.label_clock.set(object.GUI_LABEL_CLOCK)
-            self.label_clock.show()		
-            self.vbox2.add(self.label_clock)
-            self.camera_bgr = cv2.imread(object.GUI_CAMERA_IMAGE)
-            self.camera_pix = gtk.gdk.pixbuf_new_from_array(self.camera_bgr, gtk.gdk.COLORSPACE_RGB, 8)
-            self.camera_img = gtk.Image()
-            self.camera_img.set_from_pixbuf(self.camera_pix)
-            self.camera_img.show()
-            self.vbox2.add(self.camera_img)
-            self.vbox.show()
-            # Board Image
-            self.board_bgr = cv2.imread(object.GUI_BOARD_IMAGE)
-            self.board_pix = gtk.gdk.pixbuf_new_from_array(self.board_bgr, gtk.gdk.COLORSPACE_RGB, 8)
-            self.board_img = gtk.Image()
-            self.board_img.set_from_pixbuf(self.board_pix)
-            self.board_img.show()
-            self.hbox.add(self.board_img)
-            self.hbox.show()
-        except Exception as e:
-            raise e
-    
-    ## Update GUI
-    def update_gui(self, ps, r, pl, s, t):
-        self.label_pass.set(self.GUI_LABEL_PASS % ps)
-        self.label_row.set(self.GUI_LABEL_ROW % r)
-        self.label_plants.set(self.GUI_LABEL_PLANTS % pl)
-        self.label_samples.set(self.GUI_LABEL_SAMPLES % s)
-        self.label_clock.set(self.GUI_LABEL_CLOCK % t)
-        while gtk.events_pending():
-            gtk.main_iteration_do(False)
-    
-    ## Draw Board
-    def draw_board(self, observed_plants, robot_position, x=75, y=132, x_pad=154, y_pad=40, brown=(116,60,12), yellow=(219,199,6), green=(0,255,0), tall=7, short=2):
-        try:
-            board_bgr = cv2.imread(self.GUI_BOARD_IMAGE)
-            (W,H,D) = board_bgr.shape
-            (row_num, at_plant, pass_num, at_end) = robot_position
-
-            # Robot
-            if at_end == 0:
-                if row_num == 0: # if at beginning
-                    (center_x, center_y) = (W - 55, H - 55) ## 55, 55 is best
-                elif at_plant != 0:  # if at plant
-                    if pass_num == 1:
-                        (center_x, center_y) = (W - (at_plant) * x - 77, H - (row_num - 1) * y - 110)
-                    elif pass_num == 2:
-                        (center_x, center_y) = (W - (6 - at_plant) * x - 77, H - (row_num - 1) * y - 110)
-                elif pass_num == 2: # unaligned post-turn
-                    (center_x, center_y) = (W - 470, H - (row_num - 1) * y - 110) 
-                elif row_num >= 1: # unaligned post-jump
-                    (center_x, center_y) = (W - 130, H - (row_num - 1) * y - 110) 
-                elif row_num > 4: # to finish
-                    (center_x, center_y) = (W - 130, H - (row_num - 1) * y - 110)
-                else: # somewhere after plant
-                    (center_x, center_y) = (W - 470, H - (row_num - 1) * y - 110)
-            elif at_end == 1:
-                (center_x, center_y) = (W - 110, H - (row_num-1) * y - 110) # right side at row
-            elif at_end == 2:
-                (center_x, center_y) = (W - 500, H - (row_num-1) * y - 110) # left side at some row  
-            else:
-                (center_x, center_y) = (W - 55, H - 55)          
-            top_left = ((center_x - 20), (center_y - 20))
-            bottom_right = ((center_x + 20), (center_y + 20 ))
-            cv2.rectangle(board_bgr, top_left, bottom_right, (255,0,0), thickness=5)
-
-            # Plants
-            if observed_plants == []: # at start
-                pass
-            else:
-                for (r,p,c,h) in observed_plants:
-                    if h == 'tall':
-                        radius = tall
-                    if h == 'short':
-                        radius = short
-                    if c == 'green':
-                        color = green
-                    if c == 'yellow':
-                        color = yellow
-                    if c == 'brown':
-                        color = brown
-                    if c == 'blue':
-                        color = (255,0,0)
-                    center = ((W - (((p-1) * x) + x_pad)), (H - (((r-1) * y) + y_pad)))
-                    cv2.circle(board_bgr, center, radius, color, thickness=15)
-            self.board_pix = gtk.gdk.pixbuf_new_from_array(board_bgr, gtk.gdk.COLORSPACE_RGB, 8)
-            self.board_img.set_from_pixbuf(self.board_pix)
-        except Exception as e:
-            print str(e)
-
-    ## Draw Camera
-    def draw_camera(self, bgr):
+    def publish(self):
+        """ Send a state snapshot of the robot on display, with the camera frame as JPEG when it is new """
+        m = self.machine
+        snapshot = {
+            'pass_num' : m.pass_num,
+            'row_num' : m.row_num,
+            'plant_num' : m.plant_num,
+            'samples_num' : m.samples_num,
+            'clock' : m.clock,
+            'running' : m.running,
+            'plants' : m.board.plants(),
+            'board_version' : m.board.version,
+            'robot_position' : (m.row_num, m.at_plant, m.pass_num, m.at_end),
+            'frame_version' : self.bgr_version
+        }
+        parts = [json.dumps(snapshot)]
+        now = time.time()
+        if self.bgr_version != self.published_version or now - self.published_time > self.GUI_FRAME_INTERVAL: # resent for a GUI that subscribed late
+            (version, jpg) = self.frame_jpeg()
+            if jpg is not None:
+                parts.append(jpg)
         try:
-            self.camera_bgr = bgr
-            rgb = cv2.cvtColor(self.camera_bgr, cv2.COLOR_BGR2RGB)
-            self.camera_pix = gtk.gdk.pixbuf_new_from_array(rgb, gtk.gdk.COLORSPACE_RGB, 8)
-            self.camera_img.set_from_pixbuf(self.camera_pix)
-        except Exception as e:
-            print str(e)
+            self.publisher.send_multipart(parts, zmq.NOBLOCK)
+        except zmq.Again:
+            self.stats.inc('publish_dropped') # the frame goes with a later snapshot
+            return
+        if len(parts) > 1:
+            self.published_version = version
+            self.published_time = now
+    def control(self, message):
+        """ Handle a button press from the GUI, for every robot, or the GUI's metrics """
+        command = message.get('command')
+        if command == 'run':
+            self.pretty_print("GUI", "Running session ...")
+            self.running = True
+            for machine in self.machines(): machine.running = True
+        elif command == 'stop':
+            self.pretty_print("GUI", "Halting session ...")
+            self.running = False
+            for machine in self.machines(): machine.running = False
+        elif command == 'reset':
+            self.pretty_print("GUI", "Resetting to start ...")
+            self.running = False
+            for session in self.all_sessions():
+                with session.lock: # not under a request being decided
+                    session.machine.reset()
+        elif command == 'stats':
+            if self.stats.enabled: self.gui_stats = Metrics.from_state(message['stats']) # redraw rates, replaced as a whole
+        else:
+            self.pretty_print('GUI', 'Unknown command: %s' % str(command))
 # Main
 if __name__ == '__main__':
     server = Server(CONFIG_PATH)
     cherrypy.server.socket_host = server.CHERRYPY_ADDR
     cherrypy.server.socket_port = server.CHERRYPY_PORT
+    cherrypy.server.thread_pool = server.CHERRYPY_THREAD_POOL # web streams hold a thread each
     currdir = os.path.dirname(os.path.abspath(__file__))
     conf = {
-        '/': {'tools.staticdir.on':True, 'tools.staticdir.dir':os.path.join(currdir,server.CHERRYPY_STATIC_DIR)},
         '/data': {'tools.staticdir.on':True, 'tools.staticdir.dir':os.path.join(currdir,server.CHERRYPY_DATA_DIR)}, # NEED the '/' before the folder name
     }
     cherrypy.quickstart(server, '/', config=conf)
@@ -16,6 +16,7 @@ const int HALFSTEP_INTERVAL = 1100; // interval to move fully into finishing squ
 
 /* --- Serial / Commands --- */
 const int BAUD = 9600;
+const long FAST_BAUD = 115200; // after switching to binary frames
 const int OUTPUT_LENGTH = 256;
 const int BEGIN_COMMAND = 'B';
 const int ALIGN_COMMAND  = 'A';
@@ -29,7 +30,11 @@ const int WAIT_COMMAND = 'W';
 const int REPEAT_COMMAND = 'R';
 const int CLEAR_COMMAND = 'C';
 const int PING_COMMAND = 'P';
+const int BINARY_COMMAND = 'X';
 const int UNKNOWN_COMMAND = '?';
+const byte START_BYTE = 0xA5;
+const int STATUS_LENGTH = 9; // '<cBbbbhh' in protocol.py
+const int FRAME_LENGTH = STATUS_LENGTH + 3; // start, length, status, crc
 
 /* --- Constants --- */
 const int LINE_THRESHOLD = 500; // i.e. 2.5 volts
@@ -74,11 +79,13 @@ int result;
 int at_plant = 0; // 0: not at plant, 1-5: plant number
 int at_end = 0; // 0: not at end, 1: 1st end of row, 2: 2nd end of row
 int pass_num = 0; // 0: not specified, 1: right-to-left, 2: left-to-rightd
+int binary = 0; // 0: text statuses, 1: binary status frames
 RunningMedian dist = RunningMedian(DISTANCE_SAMPLES);
 RunningMedian offset = RunningMedian(OFFSET_SAMPLES);
 
 /* --- Buffers --- */
 char output[OUTPUT_LENGTH];
+byte frame[FRAME_LENGTH];
 
 /* --- Setup --- */
 void setup() {
@@ -190,6 +197,10 @@ void loop() {
       command = PING_COMMAND;
       result = ping();
       break;
+    case BINARY_COMMAND:
+      command = BINARY_COMMAND;
+      result = 0;
+      break;
     case WAIT_COMMAND:
       command = WAIT_COMMAND;
       result = wait();
@@ -206,10 +217,55 @@ void loop() {
       command = UNKNOWN_COMMAND;
       break;
     }
-    sprintf(output, "{'command':'%c','result':%d,'at_plant':%d,'at_end':%d,'pass_num':%d,'line':%d,'dist':%d}", command, result, at_plant, at_end, pass_num, int(offset.getMedian()), int(dist.getMedian()));
-    Serial.println(output);
+    if (binary) {
+      send_frame();
+    }
+    else {
+      sprintf(output, "{'command':'%c','result':%d,'at_plant':%d,'at_end':%d,'pass_num':%d,'line':%d,'dist':%d}", command, result, at_plant, at_end, pass_num, int(offset.getMedian()), int(dist.getMedian()));
+      Serial.println(output);
+    }
     Serial.flush();
+    if ((val == BINARY_COMMAND) && !binary) {
+      Serial.end();
+      Serial.begin(FAST_BAUD);
+      binary = 1;
+    }
+  }
+}
+
+/* --- Status Frames --- */
+byte crc8(byte *data, int len) {
+  byte crc = 0;
+  for (int i = 0; i < len; i++) {
+    crc ^= data[i];
+    for (int j = 0; j < 8; j++) {
+      if (crc & 0x80) {
+        crc = (crc << 1) ^ 0x07;
+      }
+      else {
+        crc = crc << 1;
+      }
+    }
   }
+  return crc;
+}
+
+void send_frame(void) {
+  int line = int(offset.getMedian());
+  int d = int(dist.getMedian());
+  frame[0] = START_BYTE;
+  frame[1] = STATUS_LENGTH;
+  frame[2] = command;
+  frame[3] = result;
+  frame[4] = at_plant;
+  frame[5] = at_end;
+  frame[6] = pass_num;
+  frame[7] = line & 0xFF; // little-endian
+  frame[8] = (line >> 8) & 0xFF;
+  frame[9] = d & 0xFF;
+  frame[10] = (d >> 8) & 0xFF;
+  frame[11] = crc8(frame + 1, STATUS_LENGTH + 1);
+  Serial.write(frame, FRAME_LENGTH);
 }
 
 /* --- Actions --- */
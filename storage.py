@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Event storage off the serving path -
+EventWriter queues (request, response) events and a background thread writes
+them in batches with insert_many. Frames are JPEG-encoded into their own
+collection and events reference them by id, so events stay small.
+RunRecorder/RunReader keep a local, append-only log of a whole run.
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+import Queue
+from bisect import bisect_right
+from datetime import datetime
+import numpy as np
+import cv2
+
+# Mongo backend
+class MongoBackend(object):
+
+    ## Initialize
+    def __init__(self, client):
+        self.client = client
+
+    ## Write a batch of documents
+    def insert_many(self, db_name, collection_name, docs):
+        from bson.binary import Binary
+        for doc in docs:
+            if 'data' in doc:
+                doc['data'] = Binary(doc['data'])
+        collection = self.client[db_name][collection_name]
+        try:
+            collection.insert_many(docs)
+        except AttributeError: # pymongo 2
+            collection.insert(docs)
+
+# File backend
+class FileBackend(object):
+    """
+    Stand-in for Mongo when it is unavailable or under test - each collection
+    is a JSON-lines file under path/<db>/, frame data is written alongside
+    """
+
+    ## Initialize
+    def __init__(self, path):
+        self.path = path
+
+    ## Write a batch of documents
+    def insert_many(self, db_name, collection_name, docs):
+        directory = os.path.join(self.path, db_name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        lines = []
+        for doc in docs:
+            if 'data' in doc:
+                doc = dict(doc)
+                filename = os.path.join(directory, '%s.%s' % (doc['_id'], doc['encoding']))
+                with open(filename, 'wb') as f:
+                    f.write(doc.pop('data'))
+                doc['file'] = filename
+            lines.append(json.dumps(doc, default=str))
+        with open(os.path.join(directory, collection_name + '.jsonl'), 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    ## Read a collection back
+    def find(self, db_name, collection_name):
+        with open(os.path.join(self.path, db_name, collection_name + '.jsonl')) as f:
+            return [json.loads(line) for line in f]
+
+# Batched writer
+class EventWriter(object):
+    """
+    put() never waits on the backend: when the queue is full the policy
+    either drops the oldest queued event, drops the new one, or blocks
+    """
+
+    ## Initialize
+    def __init__(self, backend, stats, db_format, collection_format, frames_collection='frames', time_format='%Y-%m-%d %H:%M:%S',
+                 queue_size=256, batch_size=32, interval=1.0, policy='oldest', jpeg_quality=90):
+        if policy not in ('oldest', 'newest', 'block'):
+            raise ValueError('unknown drop policy: %s' % policy)
+        self.backend = backend
+        self.stats = stats
+        self.db_format = db_format
+        self.collection_format = collection_format
+        self.frames_collection = frames_collection
+        self.time_format = time_format
+        self.queue = Queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.policy = policy
+        self.jpeg_quality = jpeg_quality
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='event-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    ## Queue an event
+    def put(self, request, response):
+        """ Returns False if an event was dropped """
+        event = (time.time(), request, response)
+        try:
+            if self.policy == 'block':
+                start = time.time()
+                self.queue.put(event)
+                self.stats.observe('store_enqueue_wait', time.time() - start)
+                return True
+            try:
+                self.queue.put_nowait(event)
+                return True
+            except Queue.Full:
+                self.stats.inc('store_dropped')
+                if self.policy == 'newest':
+                    return False
+                try:
+                    self.queue.get_nowait()
+                except Queue.Empty:
+                    pass
+                self.queue.put_nowait(event)
+                return False
+        finally:
+            self.stats.gauge('store_queue_depth', self.queue.qsize())
+
+    ## Write batches until closed
+    def run(self):
+        while self.running or not self.queue.empty():
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=self.interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if batch:
+                self.write(batch)
+
+    ## Encode and insert a batch
+    def write(self, batch):
+        start = time.time()
+        now = datetime.now()
+        db_name = now.strftime(self.db_format)
+        collection_name = now.strftime(self.collection_format)
+        (events, frames) = ([], [])
+        for (stamp, request, response) in batch:
+            timestamp = datetime.fromtimestamp(stamp).strftime(self.time_format)
+            frame_ids = []
+            for bgr in request.get('frames', [request['bgr']]):
+                (s, jpg) = cv2.imencode('.jpg', np.asarray(bgr, np.uint8), [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                if s:
+                    frame_ids.append(uuid.uuid4().hex)
+                    frames.append({'_id' : frame_ids[-1], 'time' : timestamp, 'encoding' : 'jpeg', 'data' : jpg.tostring()})
+            request = dict((k, v) for (k, v) in request.items() if k not in ('bgr', 'frames', 'payloads'))
+            request['frame_ids'] = frame_ids
+            events.append({'request' : request, 'response' : response, 'time' : timestamp})
+        try:
+            if frames:
+                self.backend.insert_many(db_name, self.frames_collection, frames)
+            self.backend.insert_many(db_name, collection_name, events)
+            self.stats.inc('store_written', len(events))
+        except Exception as error:
+            self.stats.inc('store_errors', len(events))
+            print('[%s] MONGO\tError: %s' % (now.strftime('%d/%b/%Y:%H:%M:%S'), str(error)))
+        self.stats.observe('store_batch_latency', time.time() - start)
+        self.stats.gauge('store_queue_depth', self.queue.qsize())
+
+    ## Flush queued events and stop
+    def close(self, timeout=10.0):
+        self.running = False
+        self.thread.join(timeout)
+
+# Run log
+RECORD = struct.Struct('<II') # metadata length, payload length
+INDEX = np.dtype([('offset', '<u8'), ('time', '<f8')]) # one entry per record in the .idx sidecar
+
+class RunRecorder(object):
+    """
+    Append-only log of a whole run - each record is a RECORD header, JSON
+    metadata and the frame parts exactly as the robot encoded them. The log
+    rolls over to a new segment after segment_size bytes, and every segment
+    has an .idx sidecar with the offset and time of each record.
+    """
+
+    ## Initialize
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment = -1
+        self.count = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.roll()
+
+    ## Start a new segment
+    def roll(self):
+        if self.segment >= 0:
+            self.log.close()
+            self.index.close()
+        self.segment += 1
+        path = os.path.join(self.directory, '%05d' % self.segment)
+        self.log = open(path + '.log', 'ab')
+        self.index = open(path + '.idx', 'ab')
+        self.offset = self.log.tell()
+
+    ## Append a record
+    def record(self, meta, parts=(), stamp=None):
+        """ parts are byte strings or buffers (e.g. zmq frames) stored verbatim """
+        stamp = time.time() if stamp is None else stamp
+        parts = [buffer(p) if not isinstance(p, str) else p for p in parts]
+        meta = dict(meta, parts=[len(p) for p in parts])
+        dump = json.dumps(meta)
+        size = sum(len(p) for p in parts)
+        if self.offset > 0 and self.offset + RECORD.size + len(dump) + size > self.segment_size:
+            self.roll()
+        self.log.write(RECORD.pack(len(dump), size))
+        self.log.write(dump)
+        for p in parts:
+            self.log.write(p)
+        self.log.flush() # readers only trust the index, so write it last
+        self.index.write(np.array([(self.offset, stamp)], INDEX).tostring())
+        self.index.flush()
+        self.offset += RECORD.size + len(dump) + size
+        self.count += 1
+
+    ## Close
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+class RunReader(object):
+    """
+    Random access to a run log - segments are memory-mapped and records are
+    located through the index, so reading record n parses only record n
+    """
+
+    ## Initialize
+    def __init__(self, directory):
+        self.segments = []
+        self.starts = [] # number of the first record in each segment
+        count = 0
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.idx'):
+                path = os.path.join(directory, name[:-4])
+                index = np.fromfile(path + '.idx', INDEX)
+                with open(path + '.log', 'rb') as f:
+                    log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if index.size else None
+                self.segments.append((index, log))
+                self.starts.append(count)
+                count += index.size
+        self.count = count
+        self.times = np.concatenate([index['time'] for (index, log) in self.segments]) if self.segments else np.zeros(0)
+
+    def __len__(self):
+        return self.count
+
+    ## Read record n, returns (meta, parts) with parts as buffers into the map
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.count
+        if not 0 <= n < self.count:
+            raise IndexError('record %d out of range' % n)
+        segment = bisect_right(self.starts, n) - 1
+        (index, log) = self.segments[segment]
+        offset = int(index['offset'][n - self.starts[segment]])
+        (meta_size, size) = RECORD.unpack_from(log, offset)
+        offset += RECORD.size
+        meta = json.loads(log[offset:offset + meta_size])
+        offset += meta_size
+        parts = []
+        for length in meta['parts']:
+            parts.append(buffer(log, offset, length))
+            offset += length
+        return (meta, parts)
+
+    def __iter__(self):
+        for n in range(self.count):
+            yield self[n]
+
+    ## Record number at or before a time
+    def seek(self, stamp):
+        return max(np.searchsorted(self.times, stamp, 'right') - 1, 0)
+
+    ## Decode the frames of record n
+    def frames(self, n):
+        (meta, parts) = self[n]
+        header = meta['request']
+        frames = []
+        for part in parts:
+            buf = np.frombuffer(part, np.uint8)
+            if header.get('encoding') == 'jpeg':
+                frames.append(cv2.imdecode(buf, cv2.IMREAD_COLOR))
+            else:
+                frames.append(buf.view(header['dtype']).reshape(header['shape']))
+        return frames
+
+    ## Close
+    def close(self):
+        for (index, log) in self.segments:
+            if log is not None:
+                log.close()
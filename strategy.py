@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Competition strategy -
+The server's decision state machine, free of sockets, GUI and wall clock so
+it can be driven by a live robot, a recorded run or a simulation. The clock
+and the plant identification (and optional deferral) are injected.
+
+Strategies are ordered rules (see configs/strategies/default.json), each
+matching a phase and any of last_action, at_end, at_plant, pass_num and row,
+with the action to take and an optional effect. At load the rules are
+compiled into a table over every reachable state, so a decision is one
+lookup; a state no rule covers, or a rule that can never fire, is an error.
+
+A speculative request, sent by a pipelining robot with its predicted status,
+is decided on a copy of the state; the robot's next request says whether it
+took that action, and only then is the decision committed.
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import copy
+import itertools
+import json
+import time
+from datetime import datetime
+
+# Log levels
+DEBUG = 10
+INFO = 20
+
+# Phases, checked in this order
+PAUSED = 'paused'
+GIVE_UP = 'give_up' # too little time left on the return pass
+SEARCH = 'search'
+WRAP_UP = 'wrap_up' # every row or plant seen
+PHASES = (PAUSED, GIVE_UP, SEARCH, WRAP_UP)
+PHASE_NOTES = {
+    GIVE_UP : 'Time almost up! Proceeding to end!',
+    WRAP_UP : '20 plants and/or 4 rows! Proceeding to end!'
+}
+
+# Rows: not started, rows with another after them, the last row, past it
+ROWS = ('start', 'inner', 'last', 'beyond')
+
+# Rule effects, methods of StateMachine
+EFFECTS = ('first_row', 'next_row', 'reset_row', 'plant')
+
+# State a decision changes besides the board and plant_num, committed from a confirmed speculation
+DECIDED = ('at_end', 'pass_num', 'at_plant', 'last_action', 'phase_name', 'row_num', 'samples_num', 'collected_plants')
+
+def load_rules(path):
+    with open(path) as rules:
+        return json.loads(rules.read())
+
+def compile_rules(rules, actions):
+    """
+    Build {(phase, last_action, at_end, at_plant, pass_num, row) : (action, effect)}
+    from the ordered rules, the first matching rule wins. Raises ValueError
+    for malformed rules, uncovered states or rules that never fire.
+    """
+    fields = ('phase', 'last_action', 'at_end', 'at_plant', 'pass_num', 'row')
+    domains = (PHASES, tuple(actions), (0, 1, 2), (False, True), (0, 1, 2), ROWS)
+    compiled = []
+    for (n, rule) in enumerate(rules):
+        unknown = set(rule) - set(fields + ('action', 'effect'))
+        if unknown:
+            raise ValueError('rule %d: unknown fields %s' % (n, ', '.join(sorted(unknown))))
+        if rule.get('action') not in actions:
+            raise ValueError('rule %d: unknown action %s' % (n, rule.get('action')))
+        if 'effect' in rule and rule['effect'] not in EFFECTS:
+            raise ValueError('rule %d: unknown effect %s' % (n, rule['effect']))
+        allowed = []
+        for (field, domain) in zip(fields, domains):
+            values = rule.get(field, domain)
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            if not set(values) <= set(domain):
+                raise ValueError('rule %d: %s must be in %s' % (n, field, domain))
+            allowed.append(frozenset(values))
+        compiled.append((allowed, rule['action'], rule.get('effect')))
+    table = {}
+    fired = set()
+    missing = []
+    for key in itertools.product(*domains):
+        (phase, last_action, at_end, at_plant, pass_num, row) = key
+        if (phase == GIVE_UP and pass_num != 2) or (phase == SEARCH and row == 'beyond'):
+            continue # unreachable, see StateMachine.phase()
+        for (n, (allowed, action, effect)) in enumerate(compiled):
+            if all(value in values for (value, values) in zip(key, allowed)):
+                table[key] = (action, effect)
+                fired.add(n)
+                break
+        else:
+            missing.append(key)
+    if missing:
+        raise ValueError('no rule for %d states, e.g. %s' % (len(missing), dict(zip(fields, missing[0]))))
+    unused = sorted(set(range(len(rules))) - fired)
+    if unused:
+        raise ValueError('rules %s can never fire' % ', '.join(str(n) for n in unused))
+    return table
+
+# Observed plants
+class Position(object):
+    """ Votes for the plant at one position, the majority (by confidence, then count) is shown """
+
+    ## Initialize
+    def __init__(self, row, plant):
+        self.row = row
+        self.plant = plant
+        self.votes = {} # (color, height) -> [confidence, count]
+        self.color = None
+        self.height = None
+        self.confidence = 0.0 # share of the confidence behind the shown phenotype
+        self.count = 0
+        self.version = 0
+
+    ## Vote
+    def vote(self, color, height, confidence=1.0):
+        votes = self.votes.setdefault((color, height), [0.0, 0])
+        votes[0] += confidence
+        votes[1] += 1
+        self.count += 1
+        shown = self.votes.get((self.color, self.height))
+        if shown is None or votes > shown: # ties keep the phenotype shown
+            (self.color, self.height) = (color, height)
+            shown = votes
+        total = sum(v[0] for v in self.votes.values())
+        self.confidence = shown[0] / total if total > 0 else 0.0
+    def snapshot(self):
+        return {
+            'row' : self.row,
+            'plant' : self.plant,
+            'color' : self.color,
+            'height' : self.height,
+            'confidence' : self.confidence,
+            'count' : self.count,
+            'version' : self.version
+        }
+
+class BoardState(object):
+    """
+    Observed plants keyed by (row, plant) -
+    Every observation bumps the board's version and stamps its position,
+    so changed_since(n) finds what to redraw or persist. The version keeps
+    counting through clear(), check cleared to know if positions are gone.
+    """
+
+    ## Initialize
+    def __init__(self):
+        self.positions = {}
+        self.version = 0
+        self.cleared = 0
+        self.cache = (None, []) # plants() of a version
+    def __len__(self):
+        return len(self.positions)
+    def __contains__(self, key):
+        return key in self.positions
+    def __getitem__(self, key):
+        return self.positions[key]
+
+    ## Update
+    def observe(self, row, plant, color, height, confidence=1.0):
+        """ Add a vote for the position, returns True on its first observation """
+        key = (row, plant)
+        position = self.positions.get(key)
+        first = position is None
+        if first:
+            position = self.positions[key] = Position(row, plant)
+        position.vote(color, height, confidence)
+        self.version += 1
+        position.version = self.version
+        return first
+    def clear(self):
+        self.positions = {}
+        self.version += 1
+        self.cleared = self.version
+
+    ## Query
+    def plants(self):
+        """ Returns [(row, plant, color, height)] ordered by position """
+        if self.cache[0] != self.version:
+            plants = [(p.row, p.plant, p.color, p.height) for (key, p) in sorted(self.positions.items())]
+            self.cache = (self.version, plants)
+        return self.cache[1]
+    def changed_since(self, version):
+        """ Positions observed after version, ordered by position """
+        return [p for (key, p) in sorted(self.positions.items()) if p.version > version]
+
+# State machine
+class StateMachine(object):
+
+    ## Initialize
+    def __init__(self, num_rows, num_plants, run_time, give_up_time, table, identify, defer=None, clock=time.time, log=None, log_level=INFO):
+        """
+        table is a strategy from compile_rules()
+        identify(frames) returns (color, height, confidence, bgr) for a plant
+        defer(request, row, plant) may queue a plant for later and return True
+        clock() returns the current time in seconds
+        log(task, msg) replaces the default console output
+        """
+        self.table = table
+        self.num_rows = num_rows
+        self.num_plants = num_plants
+        self.run_time = run_time
+        self.give_up_time = give_up_time
+        self.identify = identify
+        self.defer = defer or (lambda request, row, plant: False)
+        self.clock_source = clock
+        if log is not None:
+            self.pretty_print = log
+        self.log_level = log_level
+        self.decision_time = 0.0
+        self.board = BoardState()
+        self.observations = None # plants added by a speculative copy, see speculate()
+        self.reset()
+
+    ## Useful Functions
+    def pretty_print(self, task, msg):
+        date = datetime.strftime(datetime.now(), '%d/%b/%Y:%H:%M:%S')
+        print('[%s] %s\t%s' % (date, task, msg))
+
+    ## State
+    def reset(self):
+        self.running = False
+        self.row_num = 0
+        self.plant_num = 0
+        self.pass_num = 0
+        self.samples_num = 0
+        self.at_plant = 0
+        self.at_end = 0
+        self.last_action = None
+        self.phase_name = PAUSED
+        self.speculation = None # copy holding an unconfirmed speculative decision
+        self.start_time = self.clock_source()
+        self.end_time = self.start_time + self.run_time
+        self.clock = self.end_time - self.start_time
+        self.board.clear()
+        self.collected_plants = {
+            'green' : {
+                'short' : False,
+                'tall' : False                
+            },
+            'brown' : {
+                'short' : False,
+                'tall' : False                
+            },
+            'yellow' : {
+                'short' : False,
+                'tall' : False
+            }
+        }
+    def tick(self):
+        """ Count down while running, hold the remaining time while paused """
+        now = self.clock_source()
+        if self.running:
+            self.clock = self.end_time - now
+            if self.clock <= 0:
+                self.running = False
+        else:
+            self.end_time = now + self.clock
+    def add_plant(self, row, plant, color, height, confidence=1.0):
+        """ Vote for the plant at the position, returns True if it had not been seen """
+        if self.observations is not None:
+            self.observations.append((row, plant, color, height, confidence))
+        return self.board.observe(row, plant, color, height, confidence)
+    @property
+    def observed_plants(self):
+        return self.board.plants()
+    def all_collected(self):
+        return all(all(heights.values()) for heights in self.collected_plants.values())
+
+    ## Decide
+    def phase(self):
+        if not self.running:
+            return PAUSED
+        elif self.clock <= self.give_up_time and self.pass_num == 2:
+            return GIVE_UP
+        elif self.row_num <= self.num_rows and self.plant_num < self.num_plants:
+            return SEARCH
+        else:
+            return WRAP_UP
+    def row(self):
+        if self.row_num == 0:
+            return 'start'
+        elif self.row_num < self.num_rows:
+            return 'inner'
+        elif self.row_num == self.num_rows:
+            return 'last'
+        else:
+            return 'beyond'
+    def decide_action(self, request):
+        """
+        Decide the robot's next action, a speculative request is decided on a
+        copy which the next request commits if it is confirmed, else drops
+        """
+        if request.get('speculative'):
+            return self.speculate(request)
+        if request.get('confirmed'):
+            self.confirm()
+        self.speculation = None
+        return self.decide(request)
+    def decide(self, request):
+        """ Look up the action for the robot's status and apply the rule's effect """
+        start = time.time()
+        self.at_end = request['at_end']
+        self.pass_num = request['pass_num']
+        self.at_plant = request['at_plant']
+        self.last_action = request['last_action']
+        phase = self.phase()
+        if phase != self.phase_name:
+            self.phase_name = phase
+            if self.log_level <= INFO and phase in PHASE_NOTES:
+                self.pretty_print('DECIDE', PHASE_NOTES[phase])
+        key = (phase, self.last_action, self.at_end, bool(self.at_plant), self.pass_num, self.row())
+        if self.log_level <= DEBUG:
+            self.pretty_print('DECIDE', 'State: %s (result %s, %d plants, %d samples)' % (key, request['result'], self.plant_num, self.samples_num))
+        try:
+            (action, effect) = self.table[key]
+        except KeyError:
+            self.pretty_print('DECIDE', 'Error: No transition from %s' % (key,))
+            (action, effect) = ('wait', None)
+        if effect:
+            action = getattr(self, effect)(request, action)
+        self.decision_time = time.time() - start
+        if self.log_level <= DEBUG:
+            self.pretty_print('DECIDE', 'Action: %s (%.3f ms)' % (action, self.decision_time * 1000))
+        return action
+
+    ## Speculate
+    def speculate(self, request):
+        """ Decide on a copy of the state, kept until the robot confirms it took the action """
+        fork = copy.copy(self)
+        fork.board = copy.deepcopy(self.board)
+        fork.collected_plants = copy.deepcopy(self.collected_plants)
+        fork.defer = lambda request, row, plant: False # a deferred plant would be reconciled onto the live board
+        fork.observations = []
+        fork.speculation = None
+        action = fork.decide(request)
+        self.decision_time = fork.decision_time
+        self.speculation = fork
+        return action
+    def confirm(self):
+        """ Commit the pending speculative decision """
+        fork = self.speculation
+        if fork is None:
+            return # dropped by a reset
+        for (row, plant, color, height, confidence) in fork.observations: # keeps votes reconciled meanwhile
+            if self.add_plant(row, plant, color, height, confidence):
+                self.plant_num += 1
+        for key in DECIDED:
+            setattr(self, key, getattr(fork, key))
+        self.speculation = None
+
+    ## Effects
+    def first_row(self, request, action):
+        self.row_num = 1
+        return action
+    def next_row(self, request, action):
+        self.row_num = self.row_num + 1
+        return action
+    def reset_row(self, request, action):
+        self.row_num = 0
+        return action
+    def plant(self, request, action):
+        """ Identify the plant, and grab it if its phenotype has not been collected """
+        if self.pass_num == 1:
+            row = self.row_num
+            plant = self.at_plant
+        else:
+            row = self.row_num + 1
+            plant = 6 - self.at_plant # run plants backward
+        if self.all_collected() and self.defer(request, row, plant):
+            return action # nothing left to grab, reconcile the plant once classified
+        (color, height, confidence, bgr) = self.identify(request['frames'])
+        if self.log_level <= DEBUG:
+            self.pretty_print('DECIDE', 'Plant %d:%d is %s %s (%.2f)' % (row, plant, color, height, confidence))
+        if self.add_plant(row, plant, color, height, confidence):
+            self.plant_num += 1
+        if self.collected_plants[color][height]: # check if plant type has been seen yet
+            return action
+        self.collected_plants[color][height] = True # if not, set to true and grab
+        self.samples_num += 1
+        return 'grab'
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+EventWriter tests -
+Drives the batched writer against the file-backed stand-in for Mongo.
+
+Usage:
+    python test/test_storage.py
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+import cv2
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metrics import Metrics
+from storage import EventWriter, FileBackend
+
+class RecordingBackend(FileBackend):
+    """ FileBackend which also keeps the size of every batch per collection """
+
+    def __init__(self, path):
+        FileBackend.__init__(self, path)
+        self.batches = {}
+    def insert_many(self, db_name, collection_name, docs):
+        self.batches.setdefault(collection_name, []).append(len(docs))
+        FileBackend.insert_many(self, db_name, collection_name, docs)
+
+def event(n, frames=1):
+    """ A request as Server.receive_request builds it """
+    frames = [np.full((8, 8, 3), 10 * i, np.uint8) for i in range(frames)]
+    return {'type' : 'request', 'n' : n, 'frames' : frames, 'bgr' : frames[-1]}
+
+class EventWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = RecordingBackend(self.path)
+        self.stats = Metrics()
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def writer(self, **kwargs):
+        kwargs.setdefault('interval', 0.01)
+        return EventWriter(self.backend, self.stats, 'db', 'events', **kwargs)
+    def stopped(self, **kwargs):
+        """ A writer whose thread has exited, queued events are written by calling run() """
+        writer = self.writer(**kwargs)
+        writer.close()
+        return writer
+    def stored(self):
+        return self.backend.find('db', 'events')
+
+    def test_batches_up_to_batch_size(self):
+        writer = self.stopped(batch_size=32)
+        for n in range(70):
+            self.assertTrue(writer.put(event(n), {'action' : 'wait'}))
+        writer.run()
+        self.assertEqual(self.backend.batches['events'], [32, 32, 6])
+        self.assertEqual([e['request']['n'] for e in self.stored()], range(70))
+        self.assertEqual(self.stats.snapshot()['counters']['store_written'], 70)
+
+    def test_oldest_policy_drops_the_oldest(self):
+        writer = self.stopped(queue_size=3, policy='oldest')
+        self.assertEqual([writer.put(event(n), {}) for n in range(5)], [True, True, True, False, False])
+        writer.run()
+        self.assertEqual([e['request']['n'] for e in self.stored()], [2, 3, 4])
+        self.assertEqual(self.stats.snapshot()['counters']['store_dropped'], 2)
+
+    def test_newest_policy_drops_the_new_event(self):
+        writer = self.stopped(queue_size=3, policy='newest')
+        self.assertEqual([writer.put(event(n), {}) for n in range(5)], [True, True, True, False, False])
+        writer.run()
+        self.assertEqual([e['request']['n'] for e in self.stored()], [0, 1, 2])
+        self.assertEqual(self.stats.snapshot()['counters']['store_dropped'], 2)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, self.writer, policy='random')
+
+    def test_close_flushes_queued_events(self):
+        writer = self.writer(batch_size=4, interval=0.5)
+        for n in range(10):
+            writer.put(event(n), {})
+        writer.close()
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(len(self.stored()), 10)
+
+    def test_events_reference_jpeg_frames(self):
+        writer = self.stopped(frames_collection='frames')
+        writer.put(dict(event(0, frames=2), payloads=['raw']), {'action' : 'grab'})
+        writer.run()
+        (stored,) = self.stored()
+        self.assertEqual(stored['response'], {'action' : 'grab'})
+        for key in ('bgr', 'frames', 'payloads'):
+            self.assertNotIn(key, stored['request'])
+        frames = dict((doc['_id'], doc) for doc in self.backend.find('db', 'frames'))
+        self.assertEqual(len(stored['request']['frame_ids']), 2)
+        for (i, frame_id) in enumerate(stored['request']['frame_ids']):
+            doc = frames[frame_id]
+            self.assertEqual(doc['encoding'], 'jpeg')
+            bgr = cv2.imread(doc['file'])
+            self.assertEqual(bgr.shape, (8, 8, 3))
+            self.assertTrue(abs(int(bgr.mean()) - 10 * i) <= 2)
+
+if __name__ == '__main__':
+    unittest.main()
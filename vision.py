@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+"""
+McGill University
+ASABE 2015
+
+Plant phenotype classifier -
+Colour segmentation and height estimation without the server's network,
+database or GUI, so it can be used by tools, worker processes and tests.
+
+Usage:
+    classifier = load_classifier('configs/settings.json')
+    (color, height, annotated) = classifier.classify(bgr)
+    results = classifier.classify_batch(frames) # N x H x W x 3
+    results = classifier.score_batch(frames) # with confidences, for voting
+"""
+
+__author__ = 'Trevor Stanhope'
+__version__ = '0.1'
+
+# Libraries
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+import cv2
+
+# Plant colours, in the order of the classifier bits
+PLANT_COLORS = ('green', 'yellow', 'brown')
+BOX_COLORS = ((0,255,0), (0,255,255), (0,87,115)) # BGR
+ROI_RUNNER_UP = 0.75 # share of the candidate's box that keeps another colour in the region of interest
+
+def load_classifier(config_path, **overrides):
+    """ Build a classifier from a settings file, overrides replace settings """
+    with open(config_path) as config:
+        settings = json.loads(config.read())
+    settings.update(overrides)
+    return PlantClassifier.from_settings(settings)
+
+def vote(results):
+    """
+    Confidence-weighted vote over [(color, height, confidence, bgr)] of one
+    plant, returns the winner with its share of the votes and the frame
+    that supported it most strongly
+    """
+    votes = {}
+    best = {}
+    for (color, height, confidence, bgr) in results:
+        key = (color, height)
+        votes[key] = votes.get(key, 0.0) + confidence
+        if key not in best or confidence > best[key][0]:
+            best[key] = (confidence, bgr)
+    key = max(votes, key=votes.get)
+    total = sum(votes.values())
+    share = votes[key] / total if total else 0.0
+    return key[0], key[1], share, best[key][1]
+
+def largest_box(contours):
+    """ Bounding box of the largest contour, or an empty box """
+    box = (0,0,0,0)
+    largest = -1
+    for cnt in contours:
+        area = cv2.contourArea(cnt)
+        if area > largest:
+            largest = area
+            box = cv2.boundingRect(cnt)
+    return tuple(box)
+
+def build_lut(thresholds):
+    """
+    HSV->class lookup table indexed by h + 256*s + 65536*v, bit i of an
+    entry is set when the colour is inside the PLANT_COLORS[i] ranges
+    """
+    lut = np.zeros((256, 256, 256), np.uint8) # [v, s, h]
+    for (i, color) in enumerate(PLANT_COLORS):
+        for (low, high) in thresholds[color]:
+            lut[low[2]:high[2]+1, low[1]:high[1]+1, low[0]:high[0]+1] |= (1 << i)
+    return lut.ravel()
+
+def load_lut(thresholds, data_dir):
+    """
+    Load the lookup table compiled from the thresholds -
+    Tables are cached under data_dir, keyed by a hash of the thresholds, and
+    memory-mapped so later startups skip the build. Pool workers may build
+    the same table at once, each writes its own temp file and renames it
+    into place, so readers only ever see a complete table.
+    """
+    key = json.dumps([PLANT_COLORS, [thresholds[c] for c in PLANT_COLORS]])
+    digest = hashlib.sha1(key).hexdigest()[:16]
+    path = os.path.join(data_dir, 'lut_%s.npy' % digest)
+    try:
+        return np.load(path, mmap_mode='r')
+    except IOError:
+        lut = build_lut(thresholds)
+        (fd, tmp) = tempfile.mkstemp('.tmp', 'lut_%s_' % digest, data_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, lut)
+            os.rename(tmp, path) # never leave a half-written table behind
+        except OSError:
+            if not os.path.exists(path):
+                raise
+            os.remove(tmp) # another worker won the race, use its table
+        return np.load(path, mmap_mode='r')
+
+# Classifier
+class PlantClassifier(object):
+    """
+    Scratch buffers are reused between frames, so an instance must not be
+    shared between threads; give each thread or process its own.
+    """
+
+    ## Initialize
+    def __init__(self, thresholds, classifier='fused', tall_threshold=220, data_dir='data', roi_scale=0, roi_margin=16):
+        self.thresholds = thresholds
+        self.classifier = classifier
+        self.tall_threshold = tall_threshold
+        self.roi_scale = roi_scale
+        self.roi_margin = roi_margin
+        self.thin_kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(8,8))
+        self.fat_kernel = cv2.getStructuringElement(cv2.MORPH_RECT,(10,10))
+        self.brown_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(10,10))
+        if roi_scale > 1: # the same morphology at the coarse pass's scale
+            (thin, fat) = ((8 + roi_scale - 1) // roi_scale, (10 + roi_scale - 1) // roi_scale)
+            self.coarse_kernels = (
+                cv2.getStructuringElement(cv2.MORPH_RECT,(thin,thin)),
+                cv2.getStructuringElement(cv2.MORPH_RECT,(fat,fat)),
+                cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(fat,fat))
+            )
+        if classifier == 'fused':
+            self.lut = load_lut(thresholds, data_dir)
+        self.scratch = {}
+        self.confidence = 0.0
+        self.timings = {}
+        self.lap_time = time.time()
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings['CAMERA_THRESHOLDS'][settings['CAMERA_PROFILE']],
+            settings['CAMERA_CLASSIFIER'],
+            settings['CAMERA_TALL_THRESHOLD'],
+            settings['CHERRYPY_DATA_DIR'],
+            settings['CAMERA_ROI_SCALE'],
+            settings['CAMERA_ROI_MARGIN']
+        )
+
+    ## Classify
+    def classify(self, bgr):
+        """
+        Returns:
+            color : green, yellow, brown
+            height : short, tall
+            bgr : the blurred frame with the plant's bounding box drawn
+        """
+        return self.process(bgr, True, False)
+    def classify_batch(self, frames, annotate=True):
+        """
+        Classify an N x H x W x 3 array (or a list) of frames, reusing the
+        same scratch buffers for every frame. Returns a list of
+        (color, height, bgr), bgr is None unless annotate is set.
+        """
+        return [self.process(bgr, annotate, True) for bgr in frames]
+    def score(self, bgr):
+        """ classify() with the confidence of the result, as (color, height, confidence, bgr) """
+        (color, height, annotated) = self.process(bgr, True, False)
+        return color, height, self.confidence, annotated
+    def score_batch(self, frames):
+        """
+        score() over several frames with the scratch buffers of
+        classify_batch, timings are summed over the batch
+        """
+        results = []
+        timings = {}
+        for bgr in frames:
+            (color, height, annotated) = self.process(bgr, True, True)
+            results.append((color, height, self.confidence, annotated))
+            for (stage, t) in self.timings.items():
+                timings[stage] = timings.get(stage, 0.0) + t
+        self.timings = timings
+        return results
+    def classify_burst(self, frames):
+        """ Vote over several frames of the same plant, returns (color, height, confidence, bgr) """
+        return vote(self.score_batch(frames))
+    def process(self, bgr, annotate, scratch):
+        """
+        Segment the region found by locate() at full resolution, boxes are
+        mapped back to frame coordinates so the tall threshold still applies
+        """
+        self.start()
+        (H, W) = bgr.shape[:2]
+        (x0, y0, x1, y1) = self.locate(bgr)
+        self.lap('locate')
+        crop = bgr[y0:y1, x0:x1]
+        if scratch:
+            blurred = cv2.medianBlur(crop, 5, self.buffer('blur', crop.shape))
+        else:
+            blurred = cv2.medianBlur(crop, 5)
+        self.lap('blur')
+        (color, height, (x, y, w, h)) = self.detect(blurred)
+        box = (x + x0, y + y0, w, h)
+        if not annotate:
+            output = None
+        elif crop.shape == bgr.shape:
+            output = blurred.copy() if scratch else blurred
+        else:
+            output = bgr.copy()
+            output[y0:y1, x0:x1] = blurred
+        if output is not None:
+            self.annotate(output, color, box)
+        self.lap('select')
+        return color, height, output
+    def locate(self, bgr):
+        """
+        Coarse pass on a frame area-averaged down by roi_scale -
+        The colours are segmented as in segment_fused, with the kernels
+        scaled to match, and the plant candidate is the largest box of any
+        colour (as in detect). Returns the (x0, y0, x1, y1) region around
+        it, and around any colour within ROI_RUNNER_UP of it so a near tie
+        is settled at full resolution, padded by roi_margin pixels. The
+        whole frame if the region of interest is disabled or nothing was found.
+        """
+        (H, W) = bgr.shape[:2]
+        k = self.roi_scale
+        if k <= 1:
+            return (0, 0, W, H)
+        (thin, fat, brown) = self.coarse_kernels
+        small = cv2.resize(bgr, (W // k, H // k), interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+        if self.classifier == 'fused':
+            hsva = cv2.cvtColor(hsv, cv2.COLOR_BGR2BGRA)
+            index = hsva.view('<u4').reshape(hsv.shape[:2]) & 0xFFFFFF
+            labels = self.lut.take(index, mode='clip')
+        boxes = []
+        for (i, color) in enumerate(PLANT_COLORS):
+            if self.classifier == 'fused':
+                mask = labels & (1 << i)
+            else:
+                mask = self.threshold_mask(hsv, color)
+            if color == 'brown':
+                closed = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, brown)
+                dark = cv2.inRange(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), 1, 80)
+                output = cv2.erode(cv2.bitwise_and(closed, dark), brown)
+            else:
+                output = cv2.dilate(cv2.morphologyEx(mask, cv2.MORPH_OPEN, thin), fat)
+            (x, y, w, h) = largest_box(cv2.findContours(output, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2])
+            boxes.append((w * h, (x, y, x + w, y + h)))
+        largest = max(area for (area, box) in boxes)
+        if not largest:
+            return (0, 0, W, H)
+        boxes = [box for (area, box) in boxes if area >= ROI_RUNNER_UP * largest]
+        m = self.roi_margin
+        return (
+            max(min(b[0] for b in boxes) * k - m, 0),
+            max(min(b[1] for b in boxes) * k - m, 0),
+            min(max(b[2] for b in boxes) * k + m, W),
+            min(max(b[3] for b in boxes) * k + m, H)
+        )
+    def detect(self, blurred):
+        """ Returns the color, height and bounding box of the plant """
+        if self.classifier == 'fused':
+            detected_areas = self.segment_fused(blurred)
+        else:
+            detected_areas = self.segment_contours(blurred)
+        areas = [w*h for (x, y, w, h) in detected_areas]
+        i = int(np.argmax(areas)) # Find most likely
+        self.confidence = areas[i] / float(sum(areas)) if sum(areas) else 0.0 # share of the detected area
+        box = detected_areas[i]
+        if box[3] > self.tall_threshold:
+            height = 'tall'
+        else:
+            height = 'short'
+        return PLANT_COLORS[i], height, box
+    def annotate(self, bgr, color, box):
+        (x, y, w, h) = box
+        c = BOX_COLORS[PLANT_COLORS.index(color)]
+        cv2.rectangle(bgr,(x,y),(x+w,y+h), c, 2) # Draw the rectangle
+
+    ## Segmentation
+    def segment_contours(self, bgr):
+        """
+        Separate green, yellow and brown pipelines, each with its own masks
+        and contour search. Returns the bounding box of each colour.
+        """
+        hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+        detected_areas = [ (0,0,0,0) ] * 3
+        self.lap('hsv')
+
+        ## Green
+        green_mask = self.threshold_mask(hsv, 'green')
+        green_invmask = cv2.bitwise_not(green_mask)
+        green_closed = cv2.morphologyEx(green_invmask, cv2.MORPH_CLOSE, self.thin_kernel)
+        green_eroded = cv2.erode(green_closed, self.fat_kernel)
+        green_output = cv2.bitwise_not(green_eroded)
+        ret,thresh = cv2.threshold(green_output, 127, 255, 0)
+        contours = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        detected_areas[0] = largest_box(contours)
+        self.lap('green')
+
+        ## Yellow
+        yellow_mask = self.threshold_mask(hsv, 'yellow')
+        yellow_invmask = cv2.bitwise_not(yellow_mask)
+        yellow_closed = cv2.morphologyEx(yellow_invmask, cv2.MORPH_CLOSE, self.thin_kernel)
+        yellow_eroded = cv2.erode(yellow_closed, self.fat_kernel)
+        yellow_output = cv2.bitwise_not(yellow_eroded)
+        ret,thresh = cv2.threshold(yellow_output, 127, 255, 0)
+        contours = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        detected_areas[1] = largest_box(contours)
+        self.lap('yellow')
+
+        ## Brown
+        brown_grey = cv2.cvtColor(bgr,cv2.COLOR_BGR2GRAY)
+        brown_mask = self.threshold_mask(hsv, 'brown')
+        brown_closed = cv2.morphologyEx(brown_mask, cv2.MORPH_CLOSE, self.brown_kernel)
+        brown_cut = cv2.bitwise_and(brown_grey, brown_closed)
+        brown_cut[brown_cut == 0] = 255
+        brown_thresh = cv2.threshold(brown_cut, 80, 255, cv2.THRESH_BINARY)[1]
+        brown_invmask = cv2.bitwise_not(brown_thresh)
+        brown_eroded = cv2.erode(brown_invmask, self.brown_kernel)
+        ret, thresh = cv2.threshold(brown_eroded, 127, 255, 0)
+        contours = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        detected_areas[2] = largest_box(contours)
+        self.lap('brown')
+        return detected_areas
+    def segment_fused(self, bgr):
+        """
+        Single-pass equivalent of segment_contours -
+        Every pixel is labelled at once through the HSV lookup table (one
+        bit per colour), the per-colour morphology is applied to the bit
+        planes, and the three results are tiled side by side so a single
+        findContours call returns the blobs of every colour.
+        """
+        (H, W) = bgr.shape[:2]
+        hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV, self.buffer('hsv', (H, W, 3)))
+        self.lap('hsv')
+        hsva = cv2.cvtColor(hsv, cv2.COLOR_BGR2BGRA, self.buffer('hsva', (H, W, 4))) # pack each pixel into one 32-bit word
+        index = hsva.view('<u4').reshape(H, W)
+        np.bitwise_and(index, 0xFFFFFF, out=index) # h + 256*s + 65536*v
+        labels = self.lut.take(index, out=self.buffer('labels', (H, W)), mode='clip')
+        self.lap('label')
+        mask = self.buffer('mask', (H, W))
+        closed = self.buffer('closed', (H, W))
+        output = self.buffer('output', (H, W))
+        tiles = self.buffer('tiles', (H, len(PLANT_COLORS) * (W + 1)))
+        tiles[:, W::W + 1] = 0 # 1px gap keeps colours apart
+        for (i, color) in enumerate(PLANT_COLORS):
+            np.bitwise_and(labels, 1 << i, out=mask)
+            if color == 'brown':
+                cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self.brown_kernel, closed)
+                grey = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY, self.buffer('grey', (H, W)))
+                dark = cv2.inRange(grey, 1, 80, self.buffer('dark', (H, W)))
+                cv2.bitwise_and(closed, dark, closed)
+                cv2.erode(closed, self.brown_kernel, output)
+            else:
+                # not(erode(close(not mask))) == dilate(open(mask))
+                cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.thin_kernel, closed)
+                cv2.dilate(closed, self.fat_kernel, output)
+            tiles[:, i * (W + 1):i * (W + 1) + W] = output
+        self.lap('morphology')
+        contours = cv2.findContours(tiles, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        detected_areas = [ (0,0,0,0) ] * 3
+        largest = [-1] * 3
+        for cnt in contours:
+            x,y,w,h = cv2.boundingRect(cnt)
+            i = x // (W + 1)
+            area = cv2.contourArea(cnt)
+            if area > largest[i]:
+                largest[i] = area
+                detected_areas[i] = (x - i * (W + 1), y, w, h)
+        self.lap('contours')
+        return detected_areas
+    def threshold_mask(self, hsv, color):
+        """ Union of the inRange masks of every HSV range of a colour """
+        mask = None
+        for (low, high) in self.thresholds[color]:
+            m = cv2.inRange(hsv, np.array(low), np.array(high))
+            mask = m if mask is None else cv2.bitwise_or(mask, m)
+        return mask
+
+    ## Scratch buffers and stage timings
+    def buffer(self, name, shape, dtype=np.uint8):
+        """
+        Preallocated scratch array, only reallocated when a larger region
+        comes along; smaller regions get a contiguous view of its start
+        """
+        size = int(np.prod(shape))
+        buf = self.scratch.get(name)
+        if buf is None or buf.size < size:
+            buf = self.scratch[name] = np.zeros(size, dtype)
+        return buf[:size].reshape(shape)
+    def start(self):
+        self.timings = {}
+        self.lap_time = time.time()
+    def lap(self, stage):
+        """ Record the time spent in a stage since the last lap """
+        now = time.time()
+        self.timings[stage] = now - self.lap_time
+        self.lap_time = now
+
+# Worker process state, set up once per process by _init_worker
+_worker = {}
+
+def _init_worker(classifier_args, slots, shape):
+    _worker['classifier'] = PlantClassifier(*classifier_args)
+    _worker['frames'] = np.frombuffer(slots, np.uint8).reshape((-1,) + shape)
+
+def _classify_slot(slot):
+    """ Classify the frame in a shared slot and write the annotated frame back in place """
+    frames = _worker['frames']
+    (color, height, confidence, annotated) = _worker['classifier'].score(frames[slot])
+    frames[slot] = annotated
+    return color, height, confidence
+
+# Worker pool
+class ClassifierPool(object):
+    """
+    Classifies frames in worker processes -
+    Frames are passed through a ring of shared-memory slots, so only the
+    slot number and the (color, height) result cross the process boundary.
+    Submissions carry a context which is handed back by collect(), letting
+    the caller reconcile results that it did not wait for. Submissions
+    without a context are left to wait(), so the pool can be shared between
+    threads without collect() taking a result that another thread waits for.
+    """
+
+    ## Initialize
+    def __init__(self, classifier_args, processes, shape, slots=None):
+        import ctypes
+        self.shape = tuple(shape)
+        n = slots or 2 * processes
+        self.slots = multiprocessing.RawArray(ctypes.c_uint8, n * int(np.prod(self.shape)))
+        self.frames = np.frombuffer(self.slots, np.uint8).reshape((n,) + self.shape)
+        self.free = range(n)
+        self.pending = {} # slot -> (result, submitted, context)
+        self.waiting = set()
+        self.lock = threading.Lock()
+        self.pool = multiprocessing.Pool(processes, _init_worker, (classifier_args, self.slots, self.shape))
+    def close(self):
+        self.pool.terminate()
+
+    ## Submit and collect
+    def submit(self, bgr, context=None):
+        """ Queue a frame, returns its slot or None if the frame cannot be queued """
+        if bgr.shape != self.shape:
+            return None
+        with self.lock:
+            if not self.free:
+                return None
+            slot = self.free.pop()
+            self.frames[slot] = bgr
+            result = self.pool.apply_async(_classify_slot, (slot,))
+            self.pending[slot] = (result, time.time(), context)
+            if context is None:
+                self.waiting.add(slot)
+            return slot
+    def wait(self, slot, timeout=None):
+        """ Block for one submission, returns (color, height, confidence, bgr, latency) """
+        try:
+            (color, height, confidence) = self.pending[slot][0].get(timeout)
+        except multiprocessing.TimeoutError:
+            with self.lock:
+                self.waiting.discard(slot) # still running, collect() frees the slot once it finishes
+            raise
+        except Exception:
+            with self.lock: # the worker failed, nothing is left for collect()
+                self.pending.pop(slot)
+                self.waiting.discard(slot)
+                self.free.append(slot)
+            raise
+        with self.lock: # collect() only takes slots that are not waited on, so claim and free at once
+            bgr = self.frames[slot].copy()
+            (result, submitted, context) = self.pending.pop(slot)
+            self.waiting.discard(slot)
+            self.free.append(slot)
+        return color, height, confidence, bgr, time.time() - submitted
+    def collect(self):
+        """ Returns [(context, color, height, confidence, bgr, latency)] of finished submissions """
+        finished = []
+        with self.lock: # claim the ready slots, so no other caller can free them
+            ready = [(slot, self.pending.pop(slot)) for (slot, (result, submitted, context)) in self.pending.items() if result.ready() and slot not in self.waiting]
+        for (slot, (result, submitted, context)) in ready:
+            try:
+                (color, height, confidence) = result.get()
+            except Exception:
+                (color, height, confidence) = (None, None, 0.0)
+            finished.append((context, color, height, confidence) + self.release(slot, submitted))
+        return finished
+    def release(self, slot, submitted):
+        """ Free a claimed slot, returns a copy of its frame and the latency """
+        bgr = self.frames[slot].copy()
+        with self.lock:
+            self.free.append(slot)
+        return bgr, time.time() - submitted
+    def depth(self):
+        return len(self.pending)